@@ -17,7 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from itools
-from catalog import Catalog, make_catalog
+from catalog import Catalog, QueryProfiler, make_catalog
 from fields import Field, get_field_and_datatype
 from queries import AllQuery, NotQuery, StartQuery, TextQuery
 from queries import RangeQuery, PhraseQuery, AndQuery, OrQuery, pprint_query
@@ -25,7 +25,7 @@ from magic_ import magic_from_buffer, magic_from_file
 from metadata import Metadata
 from registry import get_register_fields, register_field
 from resources import Resource
-from ro import RODatabase, ReadonlyError
+from ro import GitRODatabase, RODatabase, ReadonlyError
 from rw import RWDatabase, make_git_database, check_database
 
 
@@ -35,6 +35,7 @@ __all__ = [
     # Database
     'ReadonlyError',
     'RODatabase',
+    'GitRODatabase',
     'RWDatabase',
     'make_git_database',
     'check_database',
@@ -49,6 +50,7 @@ __all__ = [
     # Xapian
     'make_catalog',
     'Catalog',
+    'QueryProfiler',
     # Queries
     'RangeQuery',
     'PhraseQuery',
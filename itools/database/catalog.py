@@ -19,23 +19,32 @@
 
 # Import from the standard library
 from decimal import Decimal as decimal
+from bisect import bisect_left
+from cStringIO import StringIO
 from datetime import datetime
 from marshal import dumps, loads
+from collections import namedtuple
 from hashlib import sha1
+from itertools import chain, islice
+from operator import itemgetter
+from time import time
+from uuid import uuid4
 
 # Import from xapian
 from xapian import Database, WritableDatabase, DB_CREATE, DB_OPEN
 from xapian import Document, Query, QueryParser, Enquire, MultiValueSorter
 from xapian import sortable_serialise, sortable_unserialise, TermGenerator
+from xapian import ValueCountMatchSpy
 
 # Import from itools
-from itools.core import fixed_offset, lazy
+from itools.core import LRUCache, fixed_offset, lazy
 from itools.datatypes import Decimal, Integer, Unicode, String
 from itools.fs import lfs
 from itools.i18n import is_punctuation
 from itools.log import log_warning
 from queries import AllQuery, _AndQuery, NotQuery, _OrQuery, PhraseQuery
 from queries import RangeQuery, StartQuery, TextQuery, _MultipleQuery
+from queries import AndQuery, get_query_key, pprint_query
 
 
 
@@ -143,11 +152,135 @@ class Doc(object):
 
 
 
+class QueryCache(LRUCache):
+    """The query cache keeps the results of the searches (the abspaths of
+    the documents found and their number).  The keys include the generation
+    of the catalog, so the results are not used anymore once the catalog
+    changes.
+
+    It is disabled by default, see "Catalog.set_query_cache".
+    """
+
+    def __init__(self, size_min, size_max=None):
+        super(QueryCache, self).__init__(size_min, size_max)
+        self.hits = 0
+        self.misses = 0
+
+
+    def lookup(self, key):
+        value = self.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.touch(key)
+        return value
+
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+
+
+class QueryProfiler(object):
+    """The query profiler records the time spent by the searches: to
+    translate the query to Xapian, to match the documents, and to decode
+    them; plus the number of documents found.
+
+    The decode time is the time to read the documents from Xapian and to
+    build the results; the default Doc objects decode their fields later,
+    when accessed, so it is not counted for them.  The number of documents
+    found is the estimate given by Xapian, not the size of the page read.
+
+    The searches slower than the threshold (in seconds) are logged, with
+    their query, in the "itools.database.slow_query" domain.  The timings
+    of all the searches are aggregated in histograms, see "get_histograms".
+
+    It is disabled by default, set it as "Catalog.profiler" to enable it.
+    """
+
+    # The upper limits of the histograms' buckets (in seconds)
+    limits = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+
+    def __init__(self, threshold=1.0):
+        self.threshold = threshold
+        self.reset()
+
+
+    def reset(self):
+        n = len(self.limits) + 1
+        self.count = 0
+        self.histograms = {}
+        for name in ('translate', 'match', 'decode', 'total'):
+            self.histograms[name] = [0] * n
+
+
+    def record(self, query, operation, translate, match, decode, matches):
+        total = translate + match + decode
+        self.count += 1
+        limits = self.limits
+        histograms = self.histograms
+        for name, value in [('translate', translate), ('match', match),
+                            ('decode', decode), ('total', total)]:
+            histograms[name][bisect_left(limits, value)] += 1
+
+        # Slow query
+        if total < self.threshold:
+            return
+        stream = StringIO()
+        pprint_query(query, stream)
+        msg = ('%s: %.3fs (translate %.3fs, match %.3fs, decode %.3fs), '
+               '%d matches\n%s')
+        msg = msg % (operation, total, translate, match, decode, matches,
+                     stream.getvalue())
+        log_warning(msg, domain='itools.database.slow_query')
+
+
+    def get_histograms(self):
+        """Returns a dict with the histograms of the translation, match,
+        decode and total times, every histogram is a list of tuples with
+        the upper limit of the bucket (None for the last one) and the number
+        of searches that fall in it.
+        """
+        limits = list(self.limits) + [None]
+        return dict([ (name, zip(limits, values))
+                      for name, values in self.histograms.iteritems() ])
+
+
+
 class SearchResults(object):
 
-    def __init__(self, database, xquery):
+    # Used by the query profiler (see "_profile")
+    _query = None
+    _translate = 0.0
+
+    def __init__(self, database, xquery, key=None):
         self._database = database
         self._xquery = xquery
+        # The canonical form of the query, used by the query cache
+        self._key = key
+
+
+    def _profile(self, operation, match, decode, matches):
+        profiler = self._database.catalog.profiler
+        if profiler is None:
+            return
+        profiler.record(self._query, operation, self._translate, match,
+                        decode, matches)
+        # The translation is counted only once
+        self._translate = 0.0
+
+
+    def _get_cache_key(self, *args):
+        """Returns the key to use with the query cache, or None if there is
+        not a query cache.
+        """
+        catalog = self._database.catalog
+        if catalog.query_cache is None or self._key is None:
+            return None
+        return (catalog.generation, self._key) + args
 
 
     @lazy
@@ -159,10 +292,27 @@ class SearchResults(object):
 
     @lazy
     def _max(self):
+        # Cache hit
+        key = self._get_cache_key('len')
+        if key is not None:
+            query_cache = self._database.catalog.query_cache
+            value = query_cache.lookup(key)
+            if value is not None:
+                return value
+
+        # Ask Xapian to check every document, so the estimate is exact, but
+        # do not build the list of matches (maxitems = 0)
         enquire = self._enquire
         db = self._database.catalog._db
         doccount = db.get_doccount()
-        return enquire.get_mset(0, doccount).size()
+        t0 = time()
+        value = enquire.get_mset(0, 0, doccount).get_matches_estimated()
+        self._profile('count', time() - t0, 0.0, value)
+
+        # Cache miss
+        if key is not None:
+            query_cache[key] = value
+        return value
 
 
     def __len__(self):
@@ -170,46 +320,133 @@ class SearchResults(object):
         return self._max
 
 
-    def search(self, query=None, **kw):
-        database = self._database
+    def get_count(self, mode='exact', check_at_least=0):
+        """Returns the number of documents found. The list of matches is
+        never built, so this is cheap even for big result sets.
 
-        xquery = _get_xquery(database.catalog, query, **kw)
-        query = Query(Query.OP_AND, [self._xquery, xquery])
-        return self.__class__(database, query)
+        The "mode" parameter says how accurate the count must be:
 
+          - "exact" (the default) returns the real number of documents
+            found, this is the same as "len(results)";
 
-    def get_documents(self, sort_by=None, reverse=False, start=0, size=0):
-        """Returns the documents for the search, sorted by weight.
+          - "estimated" returns the estimate made by Xapian, good enough to
+            show "about N results";
 
-        Four optional arguments are accepted, which will modify the documents
-        returned.
+          - "lower" and "upper" return the bounds of the estimate.
 
-        First, it is possible to sort by a field, or a list of fields, instead
-        of by the weight. The condition is that the field must be stored:
+        The "check_at_least" parameter is the minimum number of documents
+        Xapian will check to make the estimate, the bigger the value the
+        more accurate (and expensive) is the estimate.  It is ignored by the
+        "exact" mode.
+        """
+        if mode == 'exact':
+            return self._max
 
-          - "sort_by", if given it must be the name of an stored field, or
-            a list of names of stored fields. The results will be sorted by
-            this fields, instead of by the weight.
+        mset = self._enquire.get_mset(0, 0, check_at_least)
+        if mode == 'estimated':
+            return mset.get_matches_estimated()
+        elif mode == 'lower':
+            return mset.get_matches_lower_bound()
+        elif mode == 'upper':
+            return mset.get_matches_upper_bound()
 
-          - "reverse", a boolean value that says whether the results will be
-            ordered from smaller to greater (reverse is False, the default),
-            or from greater to smaller (reverse is True). This parameter only
-            takes effect if the parameter "sort_by" is also given.
+        raise ValueError, 'unexpected "%s" count mode' % mode
 
-        It is also possible to ask for a subset of the documents:
 
-          - "start": returns the documents starting from the given start
-            position.
+    def get_facets(self, names, limit=None):
+        """Returns a dict with the number of documents found for every
+        value of the given fields (a list of names of stored fields):
 
-          - "size": returns at most documents as specified by this parameter.
+          {name: {value: count}}
 
-        By default all the documents are returned.
+        All the counts are computed in one pass over the documents found.
+        If "limit" is given only the most frequent values are returned.
         """
         enquire = self._enquire
         catalog = self._database.catalog
+        fields = catalog._fields
+        metadata = catalog._metadata
+
+        # One match spy per field
+        spies = []
+        for name in names:
+            info = metadata.get(name)
+            if info is None or 'value' not in info:
+                warn_not_stored(name)
+                continue
+            spy = ValueCountMatchSpy(info['value'])
+            enquire.add_matchspy(spy)
+            spies.append((name, _get_field_cls(name, fields, info), spy))
+
+        # Go
+        doccount = catalog._db.get_doccount()
+        t0 = time()
+        try:
+            mset = enquire.get_mset(0, 0, doccount)
+        finally:
+            enquire.clear_matchspies()
+        t1 = time()
+
+        # Decode
+        facets = dict([ (name, {}) for name in names ])
+        for name, field_cls, spy in spies:
+            counts = facets[name]
+            # Case 1: multiple, the values are counted one by one
+            if field_cls.multiple:
+                for item in spy.values():
+                    for value in _decode(field_cls, item.term):
+                        counts[value] = counts.get(value, 0) + item.termfreq
+                if limit is not None and len(counts) > limit:
+                    items = sorted(counts.items(), key=itemgetter(1),
+                                   reverse=True)
+                    facets[name] = dict(items[:limit])
+            # Case 2: singleton
+            else:
+                if limit is None:
+                    items = spy.values()
+                else:
+                    items = spy.top_values(limit)
+                for item in items:
+                    value = _decode(field_cls, item.term)
+                    counts[value] = item.termfreq
+
+        self._profile('facets', t1 - t0, time() - t1,
+                      mset.get_matches_estimated())
+        return facets
+
+
+    def search(self, query=None, **kw):
+        database = self._database
+
+        catalog = database.catalog
+        t0 = time()
+        xquery = _get_xquery(catalog, query, **kw)
+        xquery = Query(Query.OP_AND, [self._xquery, xquery])
+        translate = time() - t0
+
+        # The key for the query cache
+        key = None
+        if catalog.query_cache is not None and self._key is not None:
+            key = [self._key, get_query_key(_get_query(query, **kw))]
+            key.sort()
+            key = ('AndQuery', tuple(key))
+
+        results = self.__class__(database, xquery, key)
+        # The query profiler
+        if catalog.profiler is not None:
+            query = _get_query(query, **kw)
+            if self._query is not None:
+                query = AndQuery(self._query, query)
+            results._query = query
+            results._translate = translate
+        return results
+
+
+    def _set_sort(self, sort_by, reverse):
+        enquire = self._enquire
+        metadata = self._database.catalog._metadata
 
         # sort_by != None
-        metadata = catalog._metadata
         if sort_by is not None:
             if isinstance(sort_by, list):
                 sorter = MultiValueSorter()
@@ -230,14 +467,78 @@ class SearchResults(object):
         else:
             enquire.set_sort_by_relevance()
 
+
+    def _get_doc_factory(self, fields):
+        """Returns the function that builds the results out of the Xapian
+        documents: Doc objects by default, or records with the given fields.
+        """
+        catalog = self._database.catalog
+        if fields is not None:
+            return _make_projection(catalog, fields)
+
+        metadata = catalog._metadata
+        fields = catalog._fields
+        return lambda xdoc: Doc(xdoc, fields, metadata)
+
+
+    def _get_page(self, operation, first, size, make_doc):
+        """Reads the given page of matches and returns the results, built
+        by 'make_doc'.  The time is recorded by the profiler the same way for
+        every operation.
+        """
+        t0 = time()
+        mset = self._enquire.get_mset(first, size)
+        t1 = time()
+        # Read the documents in bulk
+        mset.fetch()
+        docs = [ make_doc(x.document) for x in mset ]
+        self._profile(operation, t1 - t0, time() - t1,
+                      mset.get_matches_estimated())
+        return docs
+
+
+    def get_documents(self, sort_by=None, reverse=False, start=0, size=0,
+                      fields=None):
+        """Returns the documents for the search, sorted by weight.
+
+        Four optional arguments are accepted, which will modify the documents
+        returned.
+
+        First, it is possible to sort by a field, or a list of fields, instead
+        of by the weight. The condition is that the field must be stored:
+
+          - "sort_by", if given it must be the name of an stored field, or
+            a list of names of stored fields. The results will be sorted by
+            this fields, instead of by the weight.
+
+          - "reverse", a boolean value that says whether the results will be
+            ordered from smaller to greater (reverse is False, the default),
+            or from greater to smaller (reverse is True). This parameter only
+            takes effect if the parameter "sort_by" is also given.
+
+        It is also possible to ask for a subset of the documents:
+
+          - "start": returns the documents starting from the given start
+            position.
+
+          - "size": returns at most documents as specified by this parameter.
+
+        By default all the documents are returned.
+
+        Finally, with "fields" (a list of names of stored fields) the
+        documents returned are light records (named tuples) with only these
+        fields, decoded at once.  This is faster than the default Doc
+        objects, which decode their fields one by one when accessed.
+        """
+        self._set_sort(sort_by, reverse)
+
         # start/size
         if size == 0:
             size = self._database.catalog._db.get_doccount()
 
         # Construction of the results
-        fields = catalog._fields
-        results = [ Doc(x.document, fields, metadata)
-                    for x in enquire.get_mset(start, size) ]
+        make_doc = self._get_doc_factory(fields)
+        results = self._get_page('get_documents', start, size, make_doc)
 
         # sort_by=None/reverse=True
         if sort_by is None and reverse:
@@ -246,35 +547,135 @@ class SearchResults(object):
         return results
 
 
+    def iter_documents(self, sort_by=None, reverse=False, start=0, size=0,
+                       chunk_size=500, fields=None):
+        """Like "get_documents", but returns an iterator.  The matches are
+        read from Xapian in windows of "chunk_size" documents, so the memory
+        used does not depend on the number of documents found.
+
+        The catalog must not be modified while iterating, and the results
+        must not be iterated twice at the same time with different sort
+        arguments.
+        """
+        self._set_sort(sort_by, reverse)
+
+        # The range of matches to read
+        end = self._max
+        if size:
+            end = min(start + size, end)
+
+        make_doc = self._get_doc_factory(fields)
+
+        # sort_by=None/reverse=True: read the windows backwards
+        if sort_by is None and reverse:
+            stop = end
+            while stop > start:
+                first = max(start, stop - chunk_size)
+                docs = self._get_page('iter_documents', first, stop - first,
+                                      make_doc)
+                docs.reverse()
+                for doc in docs:
+                    yield doc
+                stop = first
+            return
+
+        # Default
+        first = start
+        while first < end:
+            size = min(chunk_size, end - first)
+            for doc in self._get_page('iter_documents', first, size,
+                                      make_doc):
+                yield doc
+            first += chunk_size
+
+
+    def get_abspaths(self, sort_by=None, reverse=False, start=0, size=0):
+        """Returns the abspaths of the documents found, the arguments are
+        the same as for "get_documents".
+
+        If the query cache is enabled the result is cached.
+        """
+        # Cache hit
+        sort_key = tuple(sort_by) if type(sort_by) is list else sort_by
+        key = self._get_cache_key(sort_key, reverse, start, size)
+        if key is not None:
+            query_cache = self._database.catalog.query_cache
+            abspaths = query_cache.lookup(key)
+            if abspaths is not None:
+                return list(abspaths)
+
+        abspaths = [ x.abspath for x in self.get_documents(
+            sort_by, reverse, start, size, fields=['abspath']) ]
+
+        # Cache miss
+        if key is not None:
+            query_cache[key] = tuple(abspaths)
+        return abspaths
+
+
     def get_resources(self, sort_by=None, reverse=False, start=0, size=0):
         database = self._database
-        abspaths = [x.abspath for x in self.get_documents(
-            sort_by, reverse, start, size)]
-        for abspath in abspaths:
-            yield database.get_resource(abspath)
+        abspaths = self.get_abspaths(sort_by, reverse, start, size)
+        for resource in database.get_resources(abspaths):
+            yield resource
+
+
+    def iter_resources(self, sort_by=None, reverse=False, start=0, size=0,
+                       chunk_size=500):
+        """Like "get_resources", but the matches are read lazily, see
+        "iter_documents".
+        """
+        database = self._database
+        documents = self.iter_documents(sort_by, reverse, start, size,
+                                        chunk_size, fields=['abspath'])
+        for document in documents:
+            yield database.get_resource(document.abspath)
 
 
 
 class Catalog(object):
 
     def __init__(self, ref, fields, read_only=False, asynchronous_mode=True):
-        # Load the database
+        # Load the database, or the shards (see "make_catalog")
         if isinstance(ref, (Database, WritableDatabase)):
-            self._db = ref
+            shards = [ref]
+        elif type(ref) is list:
+            shards = ref
         else:
             path = lfs.get_absolute_path(ref)
+            paths = get_shard_paths(path) or [path]
             if read_only:
-                self._db = Database(path)
+                shards = [ Database(x) for x in paths ]
             else:
-                self._db = WritableDatabase(path, DB_OPEN)
+                shards = [ WritableDatabase(x, DB_OPEN) for x in paths ]
+
+        # The database to read from, with many shards it combines them all
+        self._shards = shards
+        if len(shards) == 1:
+            self._db = shards[0]
+        else:
+            self._db = Database()
+            for shard in shards:
+                self._db.add_database(shard)
 
-        db = self._db
         self._asynchronous = asynchronous_mode
         self._fields = fields
 
+        # The generation changes every time the catalog changes, it is used
+        # to invalidate the query cache (disabled by default)
+        self.generation = 0
+        self.query_cache = None
+
+        # The query profiler (disabled by default)
+        self.profiler = None
+
         # Asynchronous mode
         if not read_only and asynchronous_mode:
-            db.begin_transaction(False)
+            for shard in shards:
+                shard.begin_transaction(False)
+
+        # Used by "reopen" with old versions of Xapian
+        self._revision = self._get_revision()
 
         # Load the xfields from the database
         self._metadata = {}
@@ -291,10 +692,14 @@ class Catalog(object):
         """
         if not self._asynchronous:
             raise ValueError, "The transactions are synchronous"
-        db = self._db
-        db.commit_transaction()
-        db.flush()
-        db.begin_transaction(False)
+        # A new revision, so the readers know the catalog has changed (see
+        # 'reopen')
+        self._shards[0].set_metadata('_revision', uuid4().hex)
+        for shard in self._shards:
+            shard.commit_transaction()
+            shard.flush()
+            shard.begin_transaction(False)
+        self.generation += 1
 
 
     def abort_changes(self):
@@ -302,19 +707,88 @@ class Catalog(object):
         """
         if not self._asynchronous:
             raise ValueError, "The transactions are synchronous"
-        db = self._db
-        db.cancel_transaction()
+        for shard in self._shards:
+            shard.cancel_transaction()
+        self._load_all_internal()
+        for shard in self._shards:
+            shard.begin_transaction(False)
+        self.generation += 1
+
+
+    def reopen(self):
+        """For read-only catalogs, reopen the database to see the changes
+        committed by the writer since it was opened (or reopened).  This is
+        cheap if nothing has changed.
+
+        Returns True if the catalog has changed, False otherwise.
+        """
+        changed = self._db.reopen()
+        # Old versions of Xapian do not tell whether the database changed,
+        # then compare the revisions
+        revision = self._get_revision()
+        if changed is None:
+            changed = revision != self._revision
+        self._revision = revision
+        if not changed:
+            return False
+
         self._load_all_internal()
-        db.begin_transaction(False)
+        self.generation += 1
+        return True
+
+
+    def _get_revision(self):
+        # The revision stored by 'save_changes', it changes even if the
+        # documents are replaced in place; the counts are for the catalogs
+        # saved by older versions
+        db = self._db
+        return (db.get_metadata('_revision'), db.get_doccount(),
+                db.get_lastdocid())
+
+
+    def set_query_cache(self, size_min, size_max=None):
+        """Enable the query cache with the given size (number of results),
+        or disable it if the size is 0.
+        """
+        if size_min == 0:
+            self.query_cache = None
+        else:
+            self.query_cache = QueryCache(size_min, size_max)
+
+
+    #######################################################################
+    # API / Public / Metadata
+    #######################################################################
+    def get_metadata(self, key):
+        """Return the value stored with "set_metadata" for the given key,
+        or None if there is not such value.
+        """
+        if key == 'metadata':
+            raise ValueError, 'the "metadata" key is reserved'
+        value = self._shards[0].get_metadata(key)
+        return loads(value) if value else None
+
+
+    def set_metadata(self, key, value):
+        """Store the given value in the catalog, it will be saved together
+        with the next changes.  The value must be marshalable, None removes
+        it.
+        """
+        if key == 'metadata':
+            raise ValueError, 'the "metadata" key is reserved'
+        value = dumps(value) if value is not None else ''
+        self._shards[0].set_metadata(key, value)
 
 
     #######################################################################
     # API / Public / (Un)Index
     #######################################################################
-    def index_document(self, document):
-        """Add a new document.
+    def _make_xdoc(self, document):
+        """Returns a tuple with the Xapian document built from the given
+        document, its unique key term (None if there is not the abspath
+        field), and a boolean telling whether new fields have been added to
+        the metadata.
         """
-        db = self._db
         metadata = self._metadata
         fields = self._fields
 
@@ -326,6 +800,7 @@ class Catalog(object):
 
         # Make the xapian document
         metadata_modified = False
+        key_term = None
         xdoc = Document()
         for name, value in doc_values.iteritems():
             if name not in fields:
@@ -348,7 +823,8 @@ class Catalog(object):
             #          the problem is that "_encode != _index"
             if name == 'abspath':
                 key_value = _reduce_size(_encode(field_cls, value))
-                xdoc.add_term('Q' + key_value)
+                key_term = 'Q' + key_value
+                xdoc.add_term(key_term)
 
             # A multilingual value?
             if isinstance(value, dict):
@@ -387,14 +863,73 @@ class Catalog(object):
                     # By default language='en'
                     _index(xdoc, field_cls, value, info['prefix'], 'en')
 
-        # TODO: Don't store two documents with the same key field!
+        return xdoc, key_term, metadata_modified
+
+
+    def _get_shard(self, key_term):
+        """Returns the shard where the document with the given key term is
+        stored.
+        """
+        shards = self._shards
+        n = len(shards)
+        if n == 1 or key_term is None:
+            return shards[0]
+        return shards[int(sha1(key_term).hexdigest()[:8], 16) % n]
+
+
+    def _save_xdoc(self, xdoc, key_term):
+        self.generation += 1
+        # Replace the document with the same key field, if any
+        shard = self._get_shard(key_term)
+        if key_term is None:
+            shard.add_document(xdoc)
+        else:
+            shard.replace_document(key_term, xdoc)
+
 
-        # Save the doc
-        db.add_document(xdoc)
+    def index_document(self, document):
+        """Add a new document, or replace the document with the same key
+        field (abspath).
+        """
+        xdoc, key_term, metadata_modified = self._make_xdoc(document)
+        self._save_xdoc(xdoc, key_term)
 
         # Store metadata ?
         if metadata_modified:
-            db.set_metadata('metadata', dumps(metadata))
+            self._shards[0].set_metadata('metadata', dumps(self._metadata))
+
+
+    def index_documents(self, documents, batch_size=1000):
+        """Add or replace many documents at once, see "index_document".  The
+        documents are processed in batches of the given size, the metadata
+        is stored at most once per batch.
+
+        Returns a list with one tuple per batch: the number of documents
+        indexed and the time spent (in seconds).
+        """
+        make_xdoc = self._make_xdoc
+        save_xdoc = self._save_xdoc
+
+        batches = []
+        documents = iter(documents)
+        while True:
+            t0 = time()
+            n = 0
+            metadata_modified = False
+            for document in islice(documents, batch_size):
+                xdoc, key_term, modified = make_xdoc(document)
+                save_xdoc(xdoc, key_term)
+                metadata_modified = metadata_modified or modified
+                n += 1
+
+            if n == 0:
+                return batches
+
+            # Store metadata ?
+            if metadata_modified:
+                self._shards[0].set_metadata('metadata',
+                                             dumps(self._metadata))
+            batches.append((n, time() - t0))
 
 
     def unindex_document(self, abspath):
@@ -402,7 +937,9 @@ class Catalog(object):
            If the document does not exist => no error
         """
         data = _reduce_size(_encode(self._fields['abspath'], abspath))
-        self._db.delete_document('Q' + data)
+        key_term = 'Q' + data
+        self._get_shard(key_term).delete_document(key_term)
+        self.generation += 1
 
 
     #######################################################################
@@ -423,6 +960,44 @@ class Catalog(object):
         return set([ t.term[prefix_len:] for t in self._db.allterms(prefix) ])
 
 
+    def get_terms(self, name, prefix=u'', start=None, limit=None):
+        """Return the terms of the given indexed field that begin with the
+        given prefix, in alphabetical order, as a list of tuples
+        (term, frequency), where the frequency is the number of documents
+        with that term.
+
+        The enumeration begins at the given 'start' term (to get the next
+        page), and stops after 'limit' terms, so it is fast even for fields
+        with many terms (e.g. for autocompletion).
+        """
+        metadata = self._metadata
+        # If there is a problem => an empty result
+        if name not in metadata:
+            warn_not_indexed(name)
+            return []
+
+        info = metadata[name]
+        field_cls = _get_field_cls(name, self._fields, info)
+        field_prefix = info['prefix']
+        prefix_len = len(field_prefix)
+
+        # Only the terms with the prefix are visited
+        terms = self._db.allterms(field_prefix + _encode_term(field_cls,
+                                                              prefix))
+        if start:
+            # The start term is returned by 'skip_to', there are no more
+            # terms if it raises StopIteration
+            try:
+                first = terms.skip_to(field_prefix + _encode_term(field_cls,
+                                                                  start))
+            except StopIteration:
+                return []
+            terms = chain([first], terms)
+
+        return [ (t.term[prefix_len:], t.termfreq)
+                 for t in islice(terms, limit) ]
+
+
     #######################################################################
     # API / Private
     #######################################################################
@@ -453,7 +1028,7 @@ class Catalog(object):
         self._value_nb = 0
         self._prefix_nb = 0
 
-        metadata = self._db.get_metadata('metadata')
+        metadata = self._shards[0].get_metadata('metadata')
         if metadata == '':
             self._metadata = {}
         else:
@@ -630,7 +1205,7 @@ class Catalog(object):
 
 
 
-def make_catalog(uri, fields):
+def make_catalog(uri, fields, shards=1):
     """Creates a new and empty catalog in the given uri.
 
     fields must be a dict. It contains some informations about the
@@ -640,10 +1215,33 @@ def make_catalog(uri, fields):
 
       fields = {'abspath': String(stored=True, indexed=True),
                 'name': Unicode(indexed=True), ...}
+
+    If shards is greater than 1, the catalog is split in as many Xapian
+    databases, in the "shard0", "shard1", etc. sub-folders (these may be
+    symbolic links to other disks).  The documents are stored in one shard
+    or another depending on the hash of their abspath.
     """
     path = lfs.get_absolute_path(uri)
-    db = WritableDatabase(path, DB_CREATE)
-    return Catalog(db, fields)
+    if shards == 1:
+        db = WritableDatabase(path, DB_CREATE)
+        return Catalog(db, fields)
+
+    if not lfs.exists(path):
+        lfs.make_folder(path)
+    dbs = [ WritableDatabase('%s/shard%d' % (path, i), DB_CREATE)
+            for i in range(shards) ]
+    return Catalog(dbs, fields)
+
+
+
+def get_shard_paths(path):
+    """If the catalog at the given path is split in shards, returns the list
+    of their paths (see "make_catalog").  Otherwise returns None.
+    """
+    paths = []
+    while lfs.is_folder('%s/shard%d' % (path, len(paths))):
+        paths.append('%s/shard%d' % (path, len(paths)))
+    return paths or None
 
 
 
@@ -722,11 +1320,126 @@ def _encode(field_cls, value):
 
 
 
+def _encode_term(field_cls, value):
+    """Encodes the given value as the beginning of a term of the given
+    field, the same way "_index" does.
+    """
+    if not value:
+        return ''
+
+    # The text is lowercased and without accents
+    if issubclass(field_cls, Unicode):
+        if type(value) is str:
+            value = unicode(value, 'utf-8')
+        value = value.translate(TRANSLATE_MAP).lower()
+        return value.encode('utf-8')
+
+    return _encode_simple_value(field_cls, value)
+
+
+
 def _get_field_cls(name, fields, info):
     return fields[name] if (name in fields) else fields[info['from']]
 
 
 
+def _get_decoder(field_cls):
+    """Returns the function to decode the stored values of the given field,
+    see "_decode".
+    """
+    if field_cls.multiple:
+        return lambda data: _decode(field_cls, data)
+    elif issubclass(field_cls, Integer):
+        return lambda data: int(sortable_unserialise(data))
+    elif issubclass(field_cls, Decimal):
+        return lambda data: decimal(sortable_unserialise(data))
+    return field_cls.decode
+
+
+
+projection_classes = {}
+
+def _make_projection(catalog, names):
+    """Returns a function that takes a Xapian document and returns a record
+    (a named tuple) with the values of the given fields.  The decoding is
+    the same as for Doc objects, but the slots and decoders are computed
+    only once.
+    """
+    fields = catalog._fields
+    metadata = catalog._metadata
+
+    # The record class
+    names = tuple(names)
+    record_cls = projection_classes.get(names)
+    if record_cls is None:
+        record_cls = namedtuple('Record', names, rename=True)
+        projection_classes[names] = record_cls
+
+    # The table of slots and decoders
+    table = []
+    for name in names:
+        info = metadata.get(name)
+        if info is None:
+            raise AttributeError, MSG_NOT_INDEXED_NOR_STORED.format(name=name)
+        slot = info.get('value')
+        if slot is None:
+            raise AttributeError, MSG_NOT_STORED.format(name=name)
+        field_cls = _get_field_cls(name, fields, info)
+
+        # Multilingual field: the slots of every language
+        languages = None
+        if issubclass(field_cls, Unicode) and 'from' not in info:
+            prefix = '%s_' % name
+            n = len(prefix)
+            languages = [
+                (k[n:], v['value']) for k, v in metadata.iteritems()
+                if k[:n] == prefix and 'value' in v ]
+
+        table.append((slot, _get_decoder(field_cls), field_cls.get_default,
+                      languages, field_cls.is_empty))
+
+    # The language negotiation is done once for every set of languages
+    negotiated = {}
+
+    def make_record(xdoc):
+        get_value = xdoc.get_value
+        values = []
+        for slot, decode, get_default, languages, is_empty in table:
+            # Stored value
+            raw_value = get_value(slot)
+            if raw_value:
+                values.append(decode(raw_value))
+                continue
+
+            # Multilingual field (language negotiation)
+            if languages:
+                lang_values = {}
+                for language, lang_slot in languages:
+                    raw_value = get_value(lang_slot)
+                    if raw_value:
+                        value = decode(raw_value)
+                        if not is_empty(value):
+                            lang_values[language] = value
+                if lang_values:
+                    key = tuple(sorted(lang_values))
+                    language = negotiated.get(key)
+                    if language is None:
+                        language = select_language(list(key))
+                        if language is None:
+                            language = key[0]
+                        negotiated[key] = language
+                    values.append(lang_values[language])
+                    continue
+
+            # Default
+            values.append(get_default())
+
+        return record_cls(*values)
+
+    return make_record
+
+
+
 def _reduce_size(data):
     # 'data' must be a byte string
 
@@ -863,6 +1576,25 @@ def _make_PhraseQuery(field_cls, value, prefix):
 
 
 
+def _get_query(query=None, **kw):
+    """Returns the itools query equivalent to the given arguments, which are
+    the same as for "_get_xquery".  Used by the query cache and the query
+    profiler.
+    """
+    # Case 1: a query is given
+    if query is not None:
+        return query
+
+    # Case 2: nothing has been specified, return everything
+    if not kw:
+        return AllQuery()
+
+    # Case 3: build the query from the keyword parameters
+    return AndQuery(*[ PhraseQuery(name, value)
+                       for name, value in kw.iteritems() ])
+
+
+
 def _get_xquery(catalog, query=None, **kw):
     # Case 1: a query is given
     if query is not None:
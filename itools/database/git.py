@@ -16,7 +16,9 @@
 
 # Import from the Standard Library
 from calendar import timegm
+from cStringIO import StringIO
 from datetime import datetime
+import marshal
 from os import listdir, makedirs, remove, rmdir, walk
 from os.path import abspath, dirname, exists, getmtime, isabs, isdir, isfile
 from os.path import normpath
@@ -28,9 +30,12 @@ import time
 # Import from pygit2
 from pygit2 import Repository, Signature, GitError, init_repository
 from pygit2 import GIT_SORT_REVERSE, GIT_SORT_TIME, GIT_OBJ_TREE
+from pygit2 import GIT_FILEMODE_TREE, GIT_OBJ_BLOB, GIT_OBJ_COMMIT
+from pygit2 import GIT_OBJ_TAG, GIT_RESET_HARD
 
 # Import from itools
-from itools.core import lazy
+from itools.core import LRUCache, lazy
+from itools.fs import lfs
 
 
 def message_short(commit):
@@ -55,12 +60,258 @@ def make_parent_dirs(path):
 
 
 
+def get_tree_changes(repo, a, b, prefix='', changes=None, folders=True):
+    """Returns the list of paths that differ between the trees 'a' (new)
+    and 'b' (old), either can be None.  Only the subtrees with different
+    SHAs are visited.  With 'folders' the paths of the folders are included.
+    """
+    if changes is None:
+        changes = []
+
+    a = dict([ (x.name, x) for x in a ]) if a is not None else {}
+    b = dict([ (x.name, x) for x in b ]) if b is not None else {}
+    for name in set(a) | set(b):
+        x = a.get(name)
+        y = b.get(name)
+        if x is not None and y is not None and x.hex == y.hex:
+            continue
+        path = prefix + name
+        # Folders
+        if x is not None and x.filemode == GIT_FILEMODE_TREE:
+            x = repo[x.oid]
+        else:
+            x = None
+        if y is not None and y.filemode == GIT_FILEMODE_TREE:
+            y = repo[y.oid]
+        else:
+            y = None
+        if x is None and y is None:
+            changes.append(path)
+        else:
+            if folders:
+                changes.append(path)
+            get_tree_changes(repo, x, y, '%s/' % path, changes, folders)
+
+    return changes
+
+
+
+def _match_paths(path, paths):
+    for x in paths:
+        if path == x or path.startswith('%s/' % x):
+            return True
+    return False
+
+
+
+def _format_stats(stats, width=80):
+    """Formats the given list of (path, additions, deletions) like
+    'git diff --stat'.
+    """
+    if not stats:
+        return ''
+
+    name_width = max([ len(x[0]) for x in stats ])
+    count_width = len(str(max([ x[1] + x[2] for x in stats ])))
+    graph_width = max(width - name_width - count_width - 6, 10)
+    max_total = max([ x[1] + x[2] for x in stats ])
+
+    lines = []
+    insertions = deletions = 0
+    for path, additions, removals in stats:
+        insertions += additions
+        deletions += removals
+        total = additions + removals
+        # Scale the graph
+        if max_total > graph_width:
+            additions = (additions * graph_width + max_total - 1) / max_total
+            removals = (removals * graph_width + max_total - 1) / max_total
+        lines.append(' %s | %s %s%s\n' % (path.ljust(name_width),
+                                          str(total).rjust(count_width),
+                                          '+' * additions, '-' * removals))
+
+    # Summary
+    n = len(stats)
+    summary = ' %d file%s changed' % (n, 's' if n != 1 else '')
+    if insertions:
+        summary += ', %d insertion%s(+)' % (insertions,
+                                            's' if insertions != 1 else '')
+    if deletions:
+        summary += ', %d deletion%s(-)' % (deletions,
+                                           's' if deletions != 1 else '')
+    lines.append('%s\n' % summary)
+    return ''.join(lines)
+
+
+
+class ObjectCache(LRUCache):
+    """The cache of git objects, see 'Worktree.lookup'.  It is limited by
+    the number of objects, like any LRUCache, and by the size of the blobs
+    in bytes ('size_bytes'); the least recently used objects are removed
+    first.  While an object is in the cache, the same SHA gives the same
+    object.
+    """
+
+    def __init__(self, size_min=900, size_max=1100, size_bytes=32 * 2**20):
+        super(ObjectCache, self).__init__(size_min, size_max, automatic=False)
+        self.size_bytes = size_bytes
+        self.bytes = 0
+        self.sizes = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def lookup(self, sha):
+        obj = self.get(sha)
+        if obj is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.touch(sha)
+        return obj
+
+
+    def add(self, sha, obj):
+        size = obj.size if obj.type == GIT_OBJ_BLOB else 0
+        self[sha] = obj
+        self.sizes[sha] = size
+        self.bytes += size
+
+        # Free memory
+        if len(self) > self.size_max:
+            while len(self) > self.size_min:
+                self._pop()
+        while self.bytes > self.size_bytes and len(self) > 1:
+            self._pop()
+
+
+    def _pop(self):
+        sha, obj = self.popitem()
+        self.bytes -= self.sizes.pop(sha)
+
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self),
+                'bytes': self.bytes}
+
+
+
+class LogIndex(object):
+    """A persistent index from path to the commits that changed it (with
+    respect to the first parent, like 'Worktree.git_log'), used by
+    'git_log' to answer the queries by path without walking the history.
+    Folders are indexed too.
+
+    The index is kept in the given file, where every update appends a
+    record with the commits added, so updating it is cheap.  The commits
+    are numbered in the order they are indexed (from the oldest), so the
+    most recent commits come first when sorted backwards.
+    """
+
+    def __init__(self, repo, path):
+        self.repo = repo
+        self.path = path
+        self.head = None
+        self.commits = []   # [sha, ...]
+        self.numbers = {}   # {sha: number}
+        self.paths = {}     # {path: [number, ...]}
+        self.load()
+
+
+    def load(self):
+        if not exists(self.path):
+            return
+
+        with open(self.path, 'rb') as file:
+            while True:
+                try:
+                    head, commits = marshal.load(file)
+                except EOFError:
+                    break
+                except (ValueError, TypeError):
+                    # The last record is incomplete
+                    break
+                self._add(commits)
+                self.head = head
+
+
+    def _add(self, commits):
+        numbers = self.numbers
+        index = self.paths
+        for sha, paths in commits:
+            # The same record may have been appended by another process
+            if sha in numbers:
+                continue
+            number = len(self.commits)
+            self.commits.append(sha)
+            numbers[sha] = number
+            for path in paths:
+                index.setdefault(path, []).append(number)
+
+
+    def update(self, head):
+        """Index the commits from the last one indexed to the given head.
+        If the history has been rewritten (e.g. by 'git reset') the index is
+        built again.
+        """
+        if type(head) is not str:
+            head = head.hex
+        if head == self.head:
+            return
+
+        # The commits not yet indexed
+        new = []
+        found = False
+        for commit in self.repo.walk(head, GIT_SORT_TIME):
+            if commit.hex == self.head:
+                found = True
+                break
+            new.append(commit)
+
+        records = []
+        for commit in reversed(new):
+            parents = commit.parents
+            parent = parents[0].tree if parents else None
+            changes = get_tree_changes(self.repo, commit.tree, parent)
+            records.append((commit.hex, changes))
+
+        # Save
+        if found:
+            mode = 'ab'
+        else:
+            mode = 'wb'
+            self.commits = []
+            self.numbers = {}
+            self.paths = {}
+        with open(self.path, mode) as file:
+            marshal.dump((head, records), file)
+        self._add(records)
+        self.head = head
+
+
+    def get_commits(self, paths):
+        """Returns the SHAs of the commits that changed any of the given
+        paths, the most recent first.
+        """
+        index = self.paths
+        numbers = set()
+        for path in paths:
+            numbers.update(index.get(path, ()))
+
+        commits = self.commits
+        return [ commits[x] for x in sorted(numbers, reverse=True) ]
+
+
+
 class Worktree(object):
 
     def __init__(self, path, repo):
         self.path = abspath(path) + '/'
         self.repo = repo
-        self.cache = {} # {sha: object}
+        self.cache = ObjectCache()
+        # The cache of diffs, see '_get_diff'
+        self.diff_cache = LRUCache(200, 250)
         # FIXME These two fields are already available by libgit2. TODO
         # expose them through pygit2 and use them here.
         self.index_path = '%s/.git/index' % path
@@ -106,9 +357,9 @@ class Worktree(object):
         if len(reference) == 40:
             return reference
 
-        # Case 2: reference
-        reference = self.repo.lookup_reference(reference)
+        # Case 2: reference (None if it does not exist)
         try:
+            reference = self.repo.lookup_reference(reference)
             reference = reference.resolve()
         except KeyError:
             return None
@@ -116,6 +367,17 @@ class Worktree(object):
         return reference.target
 
 
+    def _is_ancestor(self, ancestor, commit):
+        """Returns whether the first commit is an ancestor of the second
+        one (both given by their SHA).
+        """
+        try:
+            base = self.repo.merge_base(ancestor, commit)
+        except (KeyError, ValueError, GitError):
+            return False
+        return base is not None and base.hex == ancestor
+
+
     #######################################################################
     # External API
     #######################################################################
@@ -167,13 +429,19 @@ class Worktree(object):
     def lookup(self, sha):
         """Return the object by the given SHA. We use a cache to warrant that
         two calls with the same SHA will resolve to the same object, so the
-        'is' operator will work.
+        'is' operator will work, while the object is in the cache (see
+        'ObjectCache').  To compare objects use their SHA.
         """
+        if type(sha) is not str:
+            sha = sha.hex
+
         cache = self.cache
-        if sha not in cache:
-            cache[sha] = self.repo[sha]
+        obj = cache.lookup(sha)
+        if obj is None:
+            obj = self.repo[sha]
+            cache.add(sha, obj)
 
-        return cache[sha]
+        return obj
 
 
     def lookup_from_commit_by_path(self, commit, path):
@@ -195,6 +463,37 @@ class Worktree(object):
         return obj
 
 
+    def _get_sha_from_commit_by_path(self, commit, path):
+        """Like 'lookup_from_commit_by_path', but returns the SHA of the
+        object instead, without loading it.
+        """
+        obj = commit.tree
+        names = path.split('/')
+        for name in names[:-1]:
+            if name not in obj:
+                return None
+            entry = obj[name]
+            if entry.filemode != GIT_FILEMODE_TREE:
+                return None
+            obj = self.lookup(entry.oid)
+
+        name = names[-1]
+        if name not in obj:
+            return None
+        return obj[name].hex
+
+
+    @lazy
+    def log_index(self):
+        """The index of commits by path, see 'LogIndex'.
+        """
+        return LogIndex(self.repo, self._get_log_index_path())
+
+
+    def _get_log_index_path(self):
+        return '%sitools-log.index' % self.repo.path
+
+
     @property
     def index(self):
         """Gives access to the index file. Reloads the index file if it has
@@ -218,6 +517,27 @@ class Worktree(object):
         return index
 
 
+    def write_index(self):
+        """Write the index file to the disk.
+        """
+        self.index.write()
+        self.index_mtime = getmtime(self.index_path)
+
+
+    def refresh_index(self):
+        """Updates the stat data of the entries of the index file, those
+        added from a blob (see 'RWDatabase._save_changes') have none.  This
+        is 'git update-index --refresh'.
+        """
+        command = ['git', 'update-index', '-q', '--refresh']
+        try:
+            self._call(command)
+        except EnvironmentError:
+            # Files changed outside the database are left as they are
+            pass
+        self.index_mtime = None
+
+
     def update_tree_cache(self):
         """libgit2 is able to read the tree cache, but not to write it.
         To speed up 'git_commit' this method should be called from time to
@@ -300,20 +620,21 @@ class Worktree(object):
 
 
     def git_tag(self, tag_name, message):
-        """Equivalent to 'git tag', we must give the name of the tag and the message
-        TODO Implement using libgit2
+        """Equivalent to 'git tag -a', we must give the name of the tag and
+        the message.
         """
         if not tag_name or not message:
             raise ValueError('excepted tag name and message')
-        cmd = ['git', 'tag', '-a', tag_name, '-m', message]
-        return self._call(cmd)
+        head = self._resolve_reference('HEAD')
+        tagger = Signature(self.username, self.useremail)
+        return self.repo.create_tag(tag_name, head, GIT_OBJ_COMMIT, tagger,
+                                    message)
 
 
     def git_remove_tag(self, tag_name):
         if not tag_name:
             raise ValueError('excepted tag name')
-        cmd = ['git', 'tag', '-d', tag_name]
-        return self._call(cmd)
+        self.repo.lookup_reference('refs/tags/%s' % tag_name).delete()
 
 
     def git_reset(self, reference):
@@ -321,8 +642,9 @@ class Worktree(object):
         """
         if not reference:
             raise ValueError('excepted reference to reset')
-        cmd = ['git', 'reset', '--hard', '-q', reference]
-        return self._call(cmd)
+        commit = self._get_commit(reference)
+        self.repo.reset(commit.oid, GIT_RESET_HARD)
+        self.index_mtime = None
 
 
     def git_commit(self, message, author=None, date=None, tree=None):
@@ -332,8 +654,7 @@ class Worktree(object):
         # TODO Check the 'nothing to commit' case
 
         # Write index
-        self.index.write()
-        self.index_mtime = getmtime(self.index_path)
+        self.write_index()
 
         # Tree
         if tree is None:
@@ -370,8 +691,14 @@ class Worktree(object):
         author = Signature(author[0], author[1], when_time, when_offset)
 
         # Create the commit
-        return self.repo.create_commit('HEAD', author, committer, message,
-                                       tree, parents)
+        commit = self.repo.create_commit('HEAD', author, committer, message,
+                                         tree, parents)
+
+        # Keep the log index up-to-date, once it has been built
+        if 'log_index' in self.__dict__ or exists(self._get_log_index_path()):
+            self.log_index.update(commit)
+
+        return commit
 
 
     def git_log(self, paths=None, n=None, author=None, grep=None,
@@ -386,6 +713,8 @@ class Worktree(object):
           grep    -- filter out commits whose message does not match the
                      given pattern
           reverse -- return results in reverse order
+
+        The commits by path are read from the log index (see 'LogIndex').
         """
         # Get the sha
         sha = self._resolve_reference(reference)
@@ -395,9 +724,19 @@ class Worktree(object):
         if reverse is True:
             sort |= GIT_SORT_REVERSE
 
+        # The commits, by path from the index
+        if paths and reference == 'HEAD' and sha is not None:
+            log_index = self.log_index
+            log_index.update(sha)
+            repo = self.repo
+            walk = ( repo[x] for x in log_index.get_commits(paths) )
+            paths = None
+        else:
+            walk = self.repo.walk(sha, GIT_SORT_TIME)
+
         # Go
         commits = []
-        for commit in self.repo.walk(sha, GIT_SORT_TIME):
+        for commit in walk:
             # --author=<pattern>
             if author:
                 commit_author = commit.author
@@ -415,13 +754,13 @@ class Worktree(object):
                 parents = commit.parents
                 parent = parents[0] if parents else None
                 for path in paths:
-                    a = self.lookup_from_commit_by_path(commit, path)
+                    a = self._get_sha_from_commit_by_path(commit, path)
                     if parent is None:
                         if a:
                             break
                     else:
-                        b = self.lookup_from_commit_by_path(parent, path)
-                        if a is not b:
+                        b = self._get_sha_from_commit_by_path(parent, path)
+                        if a != b:
                             break
                 else:
                     continue
@@ -441,52 +780,104 @@ class Worktree(object):
         return commits
 
 
-    def git_diff(self, since, until=None, paths=None):
-        """Return the diff between two commits, eventually reduced to the
-        given paths.
+    def _get_commit(self, reference):
+        """Returns the commit the given reference (a SHA, a branch, a tag,
+        etc.) points to.
+        """
+        obj = self.repo.revparse_single(reference)
+        while obj.type == GIT_OBJ_TAG:
+            obj = self.repo[obj.target]
+        return obj
+
 
-        TODO Implement using Python's difflib standard library, to avoid
-        calling Git.
+    def _get_diff(self, since, until=None, paths=None):
+        """Returns the list of patches between the two commits (if 'until'
+        is None, between the given commit and its parent), eventually reduced
+        to the given paths.  Every patch is a tuple:
+
+          (path, additions, deletions, text)
+
+        The result is cached by the SHAs of the commits and the paths.
         """
+        since = self._get_commit(since)
         if until is None:
-            data = self._call(['git', 'show', since, '--pretty=format:'])
-            return data[1:]
+            parents = since.parents
+            old = parents[0].tree if parents else None
+            new = since.tree
+        else:
+            until = self._get_commit(until)
+            old = since.tree
+            new = until.tree
+
+        # Cache
+        key = (old.hex if old else None, new.hex,
+               tuple(paths) if paths else None)
+        patches = self.diff_cache.get(key)
+        if patches is not None:
+            return patches
+
+        # Diff
+        if old is None:
+            diff = new.diff_to_tree(swap=True)
+        else:
+            diff = old.diff_to_tree(new)
 
-        cmd = ['git', 'diff', '%s..%s' % (since, until)]
-        if paths:
-            cmd.append('--')
-            cmd.extend(paths)
-        return self._call(cmd)
+        patches = []
+        for patch in diff:
+            delta = patch.delta
+            path = delta.new_file.path or delta.old_file.path
+            if paths and not _match_paths(path, paths):
+                continue
+            context, additions, deletions = patch.line_stats
+            patches.append((path, additions, deletions, patch.patch or ''))
 
+        self.diff_cache[key] = patches
+        return patches
 
-    def git_stats(self, since, until=None, paths=None):
-        """Return statistics of the changes done between two commits,
-        eventually reduced to the given paths.
 
-        TODO Implement using libgit2
+    def git_diff(self, since, until=None, paths=None):
+        """Return the diff between two commits, eventually reduced to the
+        given paths.  If 'until' is not given, return the changes done by
+        the 'since' commit (like 'git show').
         """
-        if until is None:
-            cmd = ['git', 'show', '--pretty=format:', '--stat', since]
-            data = self._call(cmd)
-            return data[1:]
+        patches = self._get_diff(since, until, paths)
+        return ''.join([ x[3] for x in patches ])
 
-        cmd = ['git', 'diff', '--stat', '%s..%s' % (since, until)]
-        if paths:
-            cmd.append('--')
-            cmd.extend(paths)
-        return self._call(cmd)
 
+    def git_stats(self, since, until=None, paths=None):
+        """Return statistics of the changes done between two commits,
+        eventually reduced to the given paths (like 'git diff --stat').
+        """
+        patches = self._get_diff(since, until, paths)
+        return _format_stats([ x[:3] for x in patches ])
 
-    def get_files_changed(self, since, until):
-        """Return the files that have been changed between two commits.
 
-        TODO Implement with libgit2
+    def get_files_changed(self, since, until):
+        """Return the files that have been changed by the commits between
+        the two given commits.
         """
-        expr = '%s..%s' % (since, until)
-        cmd = ['git', 'show', '--numstat', '--pretty=format:', expr]
-        data = self._call(cmd)
-        lines = data.splitlines()
-        return frozenset([ line.split('\t')[-1] for line in lines if line ])
+        repo = self.repo
+        since = self._get_commit(since)
+        until = self._get_commit(until)
+
+        # Cache
+        key = ('files', since.hex, until.hex)
+        files = self.diff_cache.get(key)
+        if files is not None:
+            return files
+
+        files = []
+        walker = repo.walk(until.oid, GIT_SORT_TIME)
+        walker.hide(since.oid)
+        for commit in walker:
+            parents = commit.parents
+            parent = parents[0].tree if parents else None
+            get_tree_changes(repo, commit.tree, parent, changes=files,
+                             folders=False)
+
+        files = frozenset(files)
+        self.diff_cache[key] = files
+        return files
 
 
     def get_metadata(self, reference='HEAD'):
@@ -515,12 +906,165 @@ class Worktree(object):
 
 
 
+class GitFS(object):
+    """A read-only file system with the files of the given reference (by
+    default the HEAD), read from the git objects, so a working tree is not
+    needed.  It implements the part of the 'lfs' API used by the database.
+
+    There is an index from path to blob, and from folder to names, built
+    when the reference is resolved; 'refresh' resolves it again and only
+    visits the trees that have changed.  The modification time of a file
+    is the time it was seen changed by 'refresh'.
+    """
+
+    def __init__(self, worktree, reference='HEAD'):
+        self.worktree = worktree
+        self.reference = reference
+        self.commit = None
+        self.files = {}   # {path: blob sha}
+        self.folders = {} # {path: [name, ...]}
+        self.trees = {}   # {path: tree sha}
+        self.mtimes = {}  # {path: datetime}
+        self.mtime = datetime.now()
+        self.refresh()
+
+
+    def copy(self, reference):
+        """Returns a new file system for the given reference, its index is
+        built from this one, so only the trees that differ are visited.
+        """
+        fs = object.__new__(GitFS)
+        fs.worktree = self.worktree
+        fs.reference = reference
+        fs.commit = self.commit
+        fs.files = self.files.copy()
+        fs.folders = self.folders.copy()
+        fs.trees = self.trees.copy()
+        fs.mtimes = self.mtimes.copy()
+        fs.mtime = self.mtime
+        fs.refresh()
+        return fs
+
+
+    def refresh(self):
+        """Resolves the reference again, returns the set of paths that
+        have changed.
+        """
+        sha = self.worktree._resolve_reference(self.reference)
+        if sha is None:
+            raise LookupError, 'unable to resolve "%s"' % self.reference
+        if self.commit is not None and sha == self.commit:
+            return set()
+
+        changed = set()
+        tree = self.worktree.repo[sha].tree
+        self._update(tree, '', changed)
+        self.commit = sha
+
+        # Update the modification times
+        mtime = datetime.now()
+        mtimes = self.mtimes
+        for path in changed:
+            mtimes[path] = mtime
+        return changed
+
+
+    def _update(self, tree, prefix, changed):
+        folder = prefix[:-1]
+        if self.trees.get(folder) == tree.hex:
+            return
+        self.trees[folder] = tree.hex
+
+        repo = self.worktree.repo
+        files = self.files
+        folders = self.folders
+        names = []
+        for entry in tree:
+            name = entry.name
+            path = prefix + name
+            names.append(name)
+            if entry.filemode == GIT_FILEMODE_TREE:
+                if path in files:
+                    del files[path]
+                    changed.add(path)
+                self._update(repo[entry.oid], '%s/' % path, changed)
+            else:
+                if path in folders:
+                    self._remove_folder(path, changed)
+                if files.get(path) != entry.hex:
+                    files[path] = entry.hex
+                    changed.add(path)
+
+        # Removed
+        for name in set(folders.get(folder, ())) - set(names):
+            path = prefix + name
+            if path in files:
+                del files[path]
+                changed.add(path)
+            elif path in folders:
+                self._remove_folder(path, changed)
+        folders[folder] = names
+
+
+    def _remove_folder(self, folder, changed):
+        del self.trees[folder]
+        for name in self.folders.pop(folder):
+            path = '%s/%s' % (folder, name)
+            if path in self.files:
+                del self.files[path]
+                changed.add(path)
+            elif path in self.folders:
+                self._remove_folder(path, changed)
+        changed.add(folder)
+
+
+    #######################################################################
+    # The lfs API
+    #######################################################################
+    def exists(self, path):
+        return path in self.files or path in self.folders
+
+
+    def is_file(self, path):
+        return path in self.files
+
+
+    def is_folder(self, path):
+        return path in self.folders
+
+
+    def get_names(self, path='.'):
+        if path == '.':
+            path = ''
+        return list(self.folders.get(path, ()))
+
+
+    def get_mtime(self, path):
+        return self.mtimes.get(path, self.mtime)
+
+
+    def open(self, path, mode=None):
+        if mode not in (None, 'r', 'rb'):
+            raise IOError, 'the git file system is read-only'
+        sha = self.files.get(path)
+        if sha is None:
+            raise IOError, 'the file "%s" does not exist' % path
+        return StringIO(self.worktree.repo[sha].data)
+
+
+    resolve2 = staticmethod(lfs.resolve2)
+
+
+
 def open_worktree(path, init=False, soft=False):
     try:
         if init:
             repo = init_repository(path, False)
-        else:
+        elif exists('%s/.git' % path):
             repo = Repository('%s/.git' % path)
+        else:
+            # Bare repository
+            repo = Repository(path)
     except GitError:
         if soft:
             return None
@@ -15,14 +15,24 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from cPickle import dumps, loads
+from hashlib import sha1
+import marshal
+from os import O_APPEND, O_CREAT, O_WRONLY
+from os import close, fdopen, open as os_open, rename, write
+from os.path import split
+from tempfile import mkstemp
+from time import time
+
 # Import from itools
-from itools.core import add_type, freeze
+from itools.core import LRUCache, add_type, freeze
 from itools.csv import parse_table, Property, property_to_str
 from itools.csv import deserialize_parameters
 from itools.datatypes import String
 from itools.handlers import File, register_handler_class
 from itools.log import log_warning
-from fields import Field
+from fields import Field, get_field_and_datatype
 
 
 
@@ -36,6 +46,169 @@ class DefaultField(Field):
 
 
 
+def get_blob_sha(data):
+    """Returns the SHA of the git blob with the given data (the same as
+    'git hash-object').
+    """
+    return sha1('blob %d\0%s' % (len(data), data)).hexdigest()
+
+
+
+# The version of the format of the metadata cache file
+CACHE_VERSION = 1
+
+
+def _get_type_name(obj):
+    if not isinstance(obj, type):
+        obj = type(obj)
+    return '%s.%s' % (obj.__module__, obj.__name__)
+
+
+def get_schema_fingerprint(registry):
+    """Returns a fingerprint of the schema of the given resource classes (a
+    mapping from class id to class), that is of what decides how the
+    metadata files are parsed: the datatype, the parameters and whether the
+    fields are multiple or multilingual.  The dynamic models (class ids
+    starting by '/') are not included.
+    """
+    schema = []
+    for class_id, cls in registry.items():
+        if class_id[0] == '/':
+            continue
+        fields = []
+        for name in cls.fields:
+            field = cls.get_field(name)
+            if field is None:
+                continue
+            field, datatype = get_field_and_datatype(field)
+            parameters = getattr(field, 'parameters_schema', None) or {}
+            parameters = [ (x, _get_type_name(y))
+                           for x, y in sorted(parameters.items()) ]
+            fields.append((name, _get_type_name(datatype),
+                           getattr(datatype, 'multiple', False),
+                           getattr(field, 'multiple', False),
+                           getattr(field, 'multilingual', False),
+                           parameters))
+        fields.sort()
+        schema.append((class_id, cls.fields_soft, fields))
+    schema.sort()
+    return sha1(repr(schema)).hexdigest()
+
+
+
+class MetadataCache(object):
+    """A persistent cache of the parsed metadata files, so they are not
+    parsed again after a restart.  The key is the SHA of the git blob of the
+    metadata file.  The file begins with the fingerprint of the schema (see
+    'get_schema_fingerprint'), if it does not match the file is ignored, so
+    the cache does not go stale when the schema changes.
+
+    At most 'size' states are kept, the least recently used are dropped.
+
+    The file is a sequence of marshal records: the header, then dicts from
+    SHA to the pickled state (format, version, properties).  'sync' appends
+    the states added since the last time, at most once every 'interval'
+    seconds, every record with a single write in append mode, so the
+    records of several processes are not interleaved.  When the file has
+    twice as many states as the cache, it is written again (through a
+    temporary file of its own, so several processes may share the cache).
+    A corrupt state is dropped, as if it was not in the cache.
+    """
+
+    def __init__(self, path, interval=60, fingerprint=None, size=100000):
+        self.path = path
+        self.interval = interval
+        self.header = (CACHE_VERSION, fingerprint)
+        self.data = LRUCache(size, size + size / 10)
+        self.new = {}
+        self.saved = time()
+        # The number of states in the file, None if it must be written again
+        self.n_states = None
+        self._load()
+
+
+    def _load(self):
+        try:
+            file = open(self.path, 'rb')
+        except IOError:
+            return
+
+        data = self.data
+        with file:
+            try:
+                if marshal.load(file) != self.header:
+                    return
+                self.n_states = 0
+                while True:
+                    states = marshal.load(file)
+                    for sha, state in states.iteritems():
+                        data[sha] = state
+                    self.n_states += len(states)
+            except (EOFError, ValueError, TypeError, AttributeError):
+                # The end of the file (or an incomplete record)
+                pass
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def get(self, sha):
+        data = self.data
+        state = data.get(sha)
+        if state is None:
+            return None
+        try:
+            state = loads(state)
+        except Exception:
+            del data[sha]
+            return None
+        data.touch(sha)
+        return state
+
+
+    def set(self, sha, state):
+        state = dumps(state, 2)
+        self.data[sha] = state
+        self.new[sha] = state
+
+
+    def sync(self, force=False):
+        """Save the states added, if the interval has elapsed since the last
+        time (unless forced).
+        """
+        new = self.new
+        if not new:
+            return
+        if not force and time() - self.saved < self.interval:
+            return
+
+        data = self.data
+        n_states = self.n_states
+        if n_states is None or n_states + len(new) > 2 * data.size_max:
+            # Write the file again, atomically
+            folder, name = split(self.path)
+            fd, tmp = mkstemp(prefix='%s.' % name, dir=folder or '.')
+            with fdopen(fd, 'wb') as file:
+                marshal.dump(self.header, file)
+                marshal.dump(dict(data.iteritems()), file)
+            rename(tmp, self.path)
+            self.n_states = len(data)
+        else:
+            # Append the new states, with a single write
+            record = marshal.dumps(new)
+            fd = os_open(self.path, O_WRONLY | O_APPEND | O_CREAT, 0644)
+            try:
+                write(fd, record)
+            finally:
+                close(fd)
+            self.n_states = n_states + len(new)
+
+        self.new = {}
+        self.saved = time()
+
+
+
 class Metadata(File):
 
     class_mimetypes = ['text/x-metadata']
@@ -54,8 +227,27 @@ class Metadata(File):
 
 
     def _load_state_from_file(self, file):
-        properties = self.properties
         data = file.read()
+
+        # The metadata cache (see 'RODatabase.open_metadata_cache')
+        cache = getattr(self.database, 'metadata_cache', None)
+        if cache is None:
+            self._load_state_from_data(data)
+            return
+
+        sha = get_blob_sha(data)
+        state = cache.get(sha)
+        if state is None:
+            self._load_state_from_data(data)
+            # The schema of the dynamic models is not in the fingerprint
+            if self.format[0] != '/':
+                cache.set(sha, (self.format, self.version, self.properties))
+        else:
+            self.format, self.version, self.properties = state
+
+
+    def _load_state_from_data(self, data):
+        properties = self.properties
         parser = parse_table(data)
 
         # Read the format & version
@@ -181,6 +181,46 @@ class TextQuery(BaseQuery):
 
 
 
+def _freeze_value(value):
+    if type(value) in (list, tuple, set, frozenset):
+        return tuple([ _freeze_value(x) for x in value ])
+    elif type(value) is dict:
+        return tuple(sorted([ (k, _freeze_value(v))
+                              for k, v in value.iteritems() ]))
+    return value
+
+
+
+def get_query_key(query):
+    """Returns a canonical and hashable form of the given query, two queries
+    that are equivalent have the same key (for instance the order of the
+    atoms of an AndQuery does not matter).
+
+    This is used as the key of the query cache.
+    """
+    query_class = type(query)
+    if query_class is AllQuery:
+        return ('AllQuery',)
+    elif query_class is RangeQuery:
+        return ('RangeQuery', query.name, _freeze_value(query.left),
+                _freeze_value(query.right))
+    elif query_class in (PhraseQuery, StartQuery, TextQuery):
+        return (query_class.__name__, query.name, _freeze_value(query.value))
+    elif query_class is NotQuery:
+        return ('NotQuery', get_query_key(query.query))
+    elif isinstance(query, _MultipleQuery):
+        atoms = [ get_query_key(x) for x in query.atoms ]
+        # A single atom
+        if len(atoms) == 1:
+            return atoms[0]
+        atoms.sort()
+        name = 'AndQuery' if isinstance(query, _AndQuery) else 'OrQuery'
+        return (name, tuple(atoms))
+
+    raise TypeError, 'unexpected query "%s"' % query_class
+
+
+
 class QueryPrinter(PrettyPrinter):
 
     def _format(self, query, stream, indent, allowance, context, level):
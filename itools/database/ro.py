@@ -19,21 +19,35 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
-from sys import getrefcount
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
+from sys import getrefcount, getsizeof
+from threading import Lock
+from time import sleep, time
 
 # Import from other libraries
-from xapian import DatabaseError, DatabaseOpeningError
+from xapian import DatabaseError, DatabaseModifiedError, DatabaseOpeningError
+
+# Import from pyinotify
+try:
+    from pyinotify import WatchManager, Notifier, IN_ATTRIB, IN_CLOSE_WRITE
+    from pyinotify import IN_CREATE, IN_DELETE, IN_MODIFY, IN_MOVED_FROM
+    from pyinotify import IN_MOVED_TO, IN_Q_OVERFLOW
+except ImportError:
+    WatchManager = None
 
 # Import from itools
-from itools.core import LRUCache, lazy
+from itools.core import LRUCache, get_sizeof, lazy
 from itools.fs import lfs
 from itools.handlers import Folder, get_handler_class_by_mimetype
 from itools.log import log_warning
 from itools.uri import Path
-from catalog import Catalog, _get_xquery, SearchResults
-from git import open_worktree
-from magic_ import magic_from_file
-from metadata import Metadata
+from catalog import Catalog, _get_xquery, _get_query, SearchResults
+from queries import get_query_key
+from git import GitFS, open_worktree
+from magic_ import magic_from_buffer, magic_from_file
+from metadata import Metadata, MetadataCache, get_schema_fingerprint
 from registry import get_register_fields
 
 
@@ -44,8 +58,81 @@ class ReadonlyError(StandardError):
 
 
 
+def get_handler_cost(handler):
+    """Returns an estimate of the memory used by the given handler, in
+    bytes.  The database and the key are not counted.
+    """
+    size = getsizeof(handler)
+    for name, value in handler.__dict__.iteritems():
+        if name not in ('database', 'key'):
+            size += get_sizeof(value)
+    return size
+
+
+
+class CacheWatcher(object):
+    """Watches the working tree with inotify, and keeps the keys of the
+    files changed since the last call to 'get_changes'.  If a folder changed
+    or the kernel dropped events (queue overflow), any key may have changed.
+    """
+
+    mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MODIFY
+            | IN_MOVED_FROM | IN_MOVED_TO) if WatchManager else 0
+
+    def __init__(self, path):
+        if WatchManager is None:
+            raise ImportError, 'the inotify validation requires pyinotify'
+
+        self.path = path if path[-1] == '/' else '%s/' % path
+        self.changed = set()
+        self.everything = False
+
+        manager = WatchManager()
+        manager.add_watch(self.path, self.mask, rec=True, auto_add=True,
+                          exclude_filter=lambda x: '/.git' in x)
+        self.notifier = Notifier(manager, self._process_event, timeout=0)
+
+
+    def _process_event(self, event):
+        # Events lost (the overflow event has not the other attributes)
+        if event.mask & IN_Q_OVERFLOW:
+            self.everything = True
+        elif event.dir:
+            self.everything = True
+        else:
+            self.changed.add(event.pathname[len(self.path):])
+
+
+    def get_changes(self):
+        """Returns the set of keys changed, or None if any key may have
+        changed (a folder changed, or events were lost).
+        """
+        notifier = self.notifier
+        while notifier.check_events(0):
+            notifier.read_events()
+            notifier.process_events()
+
+        changed = None if self.everything else self.changed
+        self.changed = set()
+        self.everything = False
+        return changed
+
+
+    def stop(self):
+        self.notifier.stop()
+
+
+
 class RODatabase(object):
 
+    # The minimum number of seconds between two checks of the catalog, to
+    # see whether it has been changed by the writer (see 'reopen_catalog')
+    catalog_check_interval = 1
+
+    # How the handlers in the cache are checked against the filesystem (see
+    # 'set_cache_validation')
+    cache_validation = 'stat'
+
     def __init__(self, path, size_min=4800, size_max=5200):
         # 1. Keep the path
         if not lfs.is_folder(path):
@@ -69,10 +156,34 @@ class RODatabase(object):
 
         # 5. A mapping from key to handler
         self.cache = LRUCache(size_min, size_max, automatic=False)
+        self.cache_budget = None
+        self.cache_budgets = {}
+        self.cache_costs = {}
 
         # 6. The git cache
         self.git_cache = LRUCache(900, 1100)
 
+        # 7. The last time the catalog was checked, and whether it must be
+        # checked the next time it is searched (see 'reopen_catalog')
+        self.catalog_checked = time()
+        self.catalog_check = False
+
+        # 8. The keys checked against the filesystem, trusted until the
+        # cache is validated again (see 'set_cache_validation')
+        self.cache_valid = set()
+        self.cache_head = None
+        self.cache_watcher = None
+
+        # 9. The cache of parsed metadata (see 'open_metadata_cache')
+        self.metadata_cache = None
+
+        # 10. Shared by the snapshots (see 'get_snapshot'): the file systems
+        # of the last commits, and the state of the handlers by blob
+        self.snapshot_lock = Lock()
+        self.snapshot_fs = LRUCache(5, 10)
+        self.snapshot_last = None
+        self.snapshot_handlers = LRUCache(size_min, size_max)
+
 
     #######################################################################
     # Private API
@@ -90,6 +201,18 @@ class RODatabase(object):
         if handler is None:
             return None
 
+        # Already checked (see 'set_cache_validation')
+        cache_valid = self.cache_valid
+        if key in cache_valid:
+            return handler
+
+        handler = self._check_filesystem(key, handler)
+        if handler is not None and self.cache_validation != 'stat':
+            cache_valid.add(key)
+        return handler
+
+
+    def _check_filesystem(self, key, handler):
         # (1) Not yet loaded
         if handler.timestamp is None and handler.dirty is None:
             # Removed from the filesystem
@@ -144,6 +267,8 @@ class RODatabase(object):
         the cache, and invalidate it (and free memory at the same time).
         """
         handler = self.cache.pop(key)
+        self.cache_costs.pop(key, None)
+        self.cache_valid.discard(key)
         # Invalidate the handler
         handler.__dict__.clear()
 
@@ -163,10 +288,96 @@ class RODatabase(object):
 #       print 'RODatabase._cleanup (0): % 4d %s' % (len(self.cache), vmsize())
 #       print gc.get_count()
         self.make_room()
+        self.validate_cache()
+        self.sync_metadata_cache()
 #       print 'RODatabase._cleanup (1): % 4d %s' % (len(self.cache), vmsize())
 #       print gc.get_count()
 
 
+    #######################################################################
+    # Metadata cache
+    #######################################################################
+    def open_metadata_cache(self, path=None, interval=60, size=100000):
+        """Keep the parsed metadata files in a persistent cache, by default
+        in the 'metadata.cache' file of the database folder (see
+        'MetadataCache').  It is bound to the schema of the resource classes
+        registered, so it must be opened after they are registered.
+        """
+        if path is None:
+            path = '%s/metadata.cache' % self.path
+        fingerprint = get_schema_fingerprint(self._resources_registry)
+        self.metadata_cache = MetadataCache(path, interval, fingerprint, size)
+
+
+    def sync_metadata_cache(self, force=False):
+        """Save the metadata cache, this is called at the end of every
+        transaction, but the file is written at most once every interval.
+        """
+        if self.metadata_cache is not None:
+            self.metadata_cache.sync(force)
+
+
+    #######################################################################
+    # Cache validation
+    #######################################################################
+    def set_cache_validation(self, mode):
+        """Choose how the handlers in the cache are checked against the
+        filesystem, the modes are:
+
+          'stat'        -- on every access (the default), at the cost of one
+                           or two 'stat' calls
+          'transaction' -- once per transaction
+          'head'        -- once, then trusted until the git HEAD changes
+          'inotify'     -- once, then trusted until inotify reports the file
+                           has changed (requires pyinotify)
+
+        With 'head' the changes made to the working tree without a commit
+        are not seen.
+        """
+        if mode not in ('stat', 'transaction', 'head', 'inotify'):
+            raise ValueError, 'unexpected cache validation "%s"' % mode
+
+        # Stop watching
+        if self.cache_watcher is not None:
+            self.cache_watcher.stop()
+            self.cache_watcher = None
+
+        if mode == 'inotify':
+            self.cache_watcher = CacheWatcher(self.path_data)
+        elif mode == 'head':
+            self.cache_head = self.worktree._resolve_reference('HEAD')
+        self.cache_validation = mode
+        self.cache_valid.clear()
+
+
+    def validate_cache(self):
+        """Forget the keys that must be checked again against the
+        filesystem.  This is called at the end of every transaction, so the
+        cache never changes within a transaction.
+        """
+        mode = self.cache_validation
+        # Read the inotify events always, so they do not pile up
+        if mode == 'inotify':
+            changed = self.cache_watcher.get_changes()
+
+        cache_valid = self.cache_valid
+        if not cache_valid:
+            return
+
+        if mode == 'head':
+            head = self.worktree._resolve_reference('HEAD')
+            if head != self.cache_head:
+                self.cache_head = head
+                cache_valid.clear()
+        elif mode == 'inotify':
+            if changed is None:
+                cache_valid.clear()
+            else:
+                cache_valid.difference_update(changed)
+        else:
+            cache_valid.clear()
+
+
     #######################################################################
     # Public API
     #######################################################################
@@ -193,13 +404,106 @@ class RODatabase(object):
         self.cache[key] = handler
 
 
+    def set_cache_budget(self, budget, budgets=None):
+        """Limit the memory used by the handler cache, in bytes, besides
+        the number of handlers.  The 'budgets' argument is a mapping from
+        handler class to the budget for the handlers of that class (and its
+        subclasses), for example:
+
+          database.set_cache_budget(200 * 2**20, {File: 100 * 2**20})
+
+        Use None to go back to limit only the number of handlers.
+        """
+        self.cache_budget = budget
+        self.cache_budgets = budgets or {}
+        self.cache_costs.clear()
+
+
+    def _get_handler_cost(self, key, handler):
+        """Returns the cost of the given handler, it is estimated again only
+        when the handler has been loaded or saved since the last time.
+        """
+        state = (handler.timestamp, handler.dirty)
+        cost = self.cache_costs.get(key)
+        if cost is None or cost[0] != state:
+            cost = (state, get_handler_cost(handler))
+            self.cache_costs[key] = cost
+        return cost[1]
+
+
+    def _get_budget_class(self, handler):
+        budgets = self.cache_budgets
+        for cls in handler.__class__.__mro__:
+            if cls in budgets:
+                return cls
+        return None
+
+
+    def _make_room_budget(self):
+        """Remove handlers from the cache until it fits the memory budgets.
+        The least recently used half of the cache is visited first, starting
+        by the biggest handlers; then the rest, by recency.
+        """
+        cache = self.cache
+        budget = self.cache_budget
+        budgets = self.cache_budgets
+
+        # The cost of every handler
+        entries = []
+        totals = dict([ (x, 0) for x in budgets ])
+        total = 0
+        for key, handler in cache.iteritems():
+            cost = self._get_handler_cost(key, handler)
+            cls = self._get_budget_class(handler)
+            entries.append((key, cost, cls))
+            total += cost
+            if cls is not None:
+                totals[cls] += cost
+        handler = None
+
+        def is_over(cls):
+            if budget is not None and total > budget:
+                return True
+            return cls is not None and totals[cls] > budgets[cls]
+
+        over = set([ x for x in budgets if is_over(x) ])
+        if not over and not is_over(None):
+            return
+
+        # Discard handlers
+        n = len(entries) / 2
+        oldest = sorted(entries[:n], key=itemgetter(1), reverse=True)
+        for key, cost, cls in oldest + entries[n:]:
+            if not is_over(cls):
+                continue
+            # Skip externally referenced handlers (see 'make_room')
+            handler = cache[key]
+            refcount = getrefcount(handler)
+            if refcount > 3 or handler.dirty is not None:
+                handler = None
+                continue
+            handler = None
+            self._discard_handler(key)
+            total -= cost
+            if cls is not None:
+                totals[cls] -= cost
+            # Check whether we are done
+            over = set([ x for x in over if is_over(x) ])
+            if not over and not is_over(None):
+                return
+
+
     def make_room(self):
-        """Remove handlers from the cache until it fits the defined size.
+        """Remove handlers from the cache until it fits the defined size,
+        and the memory budgets if any (see 'set_cache_budget').
 
         Use with caution. If the handlers we are about to discard are still
         used outside the database, and one of them (or more) are modified, then
         there will be an error.
         """
+        if self.cache_budget is not None or self.cache_budgets:
+            self._make_room_budget()
+
         # Find out how many handlers should be removed
         size = len(self.cache)
         if size < self.cache.size_max:
@@ -411,6 +715,10 @@ class RODatabase(object):
         if metadata is None:
             return None
 
+        return self._make_resource(abspath, path, metadata)
+
+
+    def _make_resource(self, abspath, path, metadata):
         # 2. Class
         class_id = metadata.format
         cls = self.get_resource_class(class_id)
@@ -432,6 +740,90 @@ class RODatabase(object):
         return resource
 
 
+    def _read_file(self, key):
+        """Returns the data and the modification time of the given file, or
+        None if it does not exist.  Called from the threads of
+        'get_resources'.
+        """
+        fs = self.fs
+        if not fs.exists(key):
+            return None
+        file = fs.open(key)
+        try:
+            data = file.read()
+        finally:
+            file.close()
+        return data, fs.get_mtime(key)
+
+
+    def get_resources(self, abspaths, soft=False, threads=None):
+        """Returns the list of resources for the given abspaths, in the same
+        order.  It is the same as calling 'get_resource' for each one, but
+        the metadata files not loaded yet are read in bulk, by a pool of
+        'threads' threads if given.
+
+        With 'soft' the resources that do not exist are None.
+        """
+        # 1. Get the metadata handlers, through the same path as
+        # 'get_resource' (the cache, the class check, the hooks)
+        items = []
+        missing = {}
+        for abspath in abspaths:
+            if type(abspath) is str:
+                path = abspath[1:]
+                abspath = Path(abspath)
+            else:
+                path = str(abspath)[1:]
+            key = self.normalize_key('%s.metadata' % path)
+            metadata = self._get_handler(key, Metadata, soft=True)
+            if metadata is None and not soft:
+                raise LookupError, 'the resource "%s" does not exist' % abspath
+            items.append((abspath, path, metadata))
+            # Not loaded yet
+            if metadata is not None and metadata.timestamp is None:
+                if metadata.dirty is None:
+                    missing[key] = metadata
+
+        # 2. Read the metadata files not loaded yet
+        if missing:
+            keys = missing.keys()
+            if threads:
+                pool = ThreadPool(threads)
+                try:
+                    states = pool.map(self._read_file, keys)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                states = [ self._read_file(x) for x in keys ]
+
+            # Load the handlers (parsing is not done in the threads)
+            for key, state in zip(keys, states):
+                handler = missing[key]
+                if state is None:
+                    # Removed meanwhile, it will be loaded (and fail) as
+                    # usual when used
+                    continue
+                data, mtime = state
+                handler.reset()
+                try:
+                    handler._load_state_from_file(StringIO(data))
+                except Exception:
+                    self._discard_handler(key)
+                    raise
+                handler.timestamp = mtime
+                handler.dirty = None
+
+        # 3. Build the resources
+        resources = []
+        for abspath, path, metadata in items:
+            if metadata is None:
+                resources.append(None)
+            else:
+                resources.append(self._make_resource(abspath, path, metadata))
+        return resources
+
+
     def remove_resource(self, resource):
          raise ReadonlyError
 
@@ -449,7 +841,9 @@ class RODatabase(object):
 
 
     def save_changes(self):
-        return
+        self.validate_cache()
+        self.sync_metadata_cache()
+        self.reopen_catalog()
 
 
     def create_tag(self, tag_name, message=None):
@@ -461,7 +855,9 @@ class RODatabase(object):
 
 
     def abort_changes(self):
-        return
+        self.validate_cache()
+        self.sync_metadata_cache()
+        self.reopen_catalog()
 
 
     def push_phantom(self, key, handler):
@@ -496,6 +892,34 @@ class RODatabase(object):
         return self.get_blob(obj.sha, cls)
 
 
+    def get_snapshot(self, sha='HEAD'):
+        """Returns a read-only view of the database as of the given commit,
+        by default the HEAD (see 'Snapshot').
+        """
+        commit = self.worktree._resolve_reference(sha)
+        if commit is None:
+            raise LookupError, 'unable to resolve "%s"' % sha
+        if type(commit) is not str:
+            commit = commit.hex
+
+        # The file system, built from the one of the last snapshot
+        lock = self.snapshot_lock
+        with lock:
+            fs = self.snapshot_fs.get(commit)
+            last = self.snapshot_last
+        if fs is None:
+            if last is None:
+                fs = GitFS(self.worktree, commit)
+            else:
+                fs = last.copy(commit)
+            with lock:
+                self.snapshot_fs[commit] = fs
+                self.snapshot_last = fs
+
+        return Snapshot(self, fs)
+
+
+
     #######################################################################
     # Search
     #######################################################################
@@ -509,12 +933,272 @@ class RODatabase(object):
             return None
 
 
+    def reopen_catalog(self):
+        """Reopen the catalog if the writer has committed changes, so the
+        searches do not return stale results.  This is called at the end of
+        every request (through 'save_changes' or 'abort_changes'), then the
+        check is done by the first search of the next request; so the
+        catalog never changes within a request, and it is checked even if
+        the process has been idle since the last request.
+
+        The check is done at most once every 'catalog_check_interval'
+        seconds, and only if the catalog has been used.
+        """
+        self.catalog_check = True
+
+
+    def _check_catalog(self):
+        # The check is kept pending until it is done, so it is not lost if
+        # it is asked for within the interval
+        if not self.catalog_check:
+            return
+
+        # Not yet loaded
+        if 'catalog' not in self.__dict__:
+            self.catalog_check = False
+            return
+
+        now = time()
+        if now - self.catalog_checked < self.catalog_check_interval:
+            return
+        self.catalog_checked = now
+        self.catalog_check = False
+
+        # The catalog could not be opened, try again the next time
+        catalog = self.catalog
+        if catalog is None:
+            del self.catalog
+            return
+
+        try:
+            catalog.reopen()
+        except DatabaseError:
+            log_warning('failed to reopen the catalog',
+                        domain='itools.database')
+
+
     def search(self, query=None, **kw):
         """Launch a search in the catalog.
         """
-        xquery = _get_xquery(self.catalog, query, **kw)
-        return SearchResults(self, xquery)
+        self._check_catalog()
+        catalog = self.catalog
+        t0 = time()
+        xquery = _get_xquery(catalog, query, **kw)
+        translate = time() - t0
+
+        # The key for the query cache
+        key = None
+        if catalog.query_cache is not None:
+            key = get_query_key(_get_query(query, **kw))
+
+        results = SearchResults(self, xquery, key)
+        # The query profiler
+        if catalog.profiler is not None:
+            results._query = _get_query(query, **kw)
+            results._translate = translate
+        return results
 
 
     def reindex_catalog(self, base_abspath, recursif=True):
         raise ReadonlyError
+
+
+
+class GitRODatabase(RODatabase):
+    """A read-only database that reads the handlers from the git objects of
+    the given reference (by default the HEAD), instead of the working tree;
+    so there is no need of a working tree, the 'database' folder may be a
+    bare repository (see 'GitFS').
+
+    The reference is resolved again at the end of every request, then the
+    handlers of the files that changed are discarded from the cache.
+    """
+
+    def __init__(self, path, size_min=4800, size_max=5200, reference='HEAD'):
+        super(GitRODatabase, self).__init__(path, size_min, size_max)
+        self.fs = GitFS(self.worktree, reference)
+
+
+    def get_mimetype(self, key):
+        file = self.fs.open(key)
+        return magic_from_buffer(file.read())
+
+
+    def validate_cache(self):
+        # The cached handlers of the files changed are checked again
+        changed = self.fs.refresh()
+        if changed:
+            self.cache_valid.difference_update(changed)
+        super(GitRODatabase, self).validate_cache()
+
+
+
+class Snapshot(GitRODatabase):
+    """A read-only view of the database as of a commit, the handlers are
+    read from the git objects (see 'RODatabase.get_snapshot').  Nothing
+    changes within a snapshot, so many threads may read from snapshots
+    while the database is changed by a writer.
+
+    The handlers are loaded at once, their state is immutable and is
+    shared by the snapshots of the database, by path and blob.  Every
+    snapshot has its own handler objects, bound to it.  The caches of the
+    database (metadata and git objects) are not used, they are not
+    thread-safe.
+
+    Every snapshot opens its own catalog, the Xapian objects are not
+    thread-safe either.  The catalog must index the commit of the snapshot
+    (see the 'last_commit' metadata), else searching raises LookupError.
+    With write-behind or group commit the catalog lags behind the git
+    commits, then the snapshot waits up to 'catalog_wait' seconds for it
+    to catch up (see '_wait_catalog').
+    """
+
+    catalog_wait = 5.0
+
+
+    def __init__(self, database, fs):
+        # Share the state of the database, instead of opening it again
+        self.path = database.path
+        self.path_data = database.path_data
+        self.worktree = database.worktree
+        self.fs = fs
+        self.commit = fs.commit
+        self.metadata_cache = None
+        self.git_cache = LRUCache(900, 1100)
+        # The handlers, of this snapshot and shared
+        self.cache = {}
+        self.handlers = database.snapshot_handlers
+        self.lock = database.snapshot_lock
+        self.origin = database
+
+
+    @lazy
+    def catalog(self):
+        path = '%s/catalog' % self.path
+        catalog = Catalog(path, get_register_fields(), read_only=True)
+        self._wait_catalog(catalog)
+        return catalog
+
+
+    def _wait_catalog(self, catalog):
+        """Waits until the catalog indexes the commit of the snapshot.
+        Raises LookupError if it indexes a commit that is not an ancestor
+        (then it will never catch up), or if it still lags behind after
+        'catalog_wait' seconds.
+        """
+        commit = self.commit
+        worktree = self.worktree
+        deadline = time() + self.catalog_wait
+        while True:
+            last = catalog.get_metadata('last_commit')
+            if last == commit:
+                return
+            if last is None or not worktree._is_ancestor(last, commit):
+                error = 'the catalog does not index the commit "%s"'
+                raise LookupError, error % commit
+            if time() > deadline:
+                error = 'the catalog lags behind the commit "%s"'
+                raise LookupError, error % commit
+            sleep(0.05)
+            catalog.reopen()
+
+
+    def _check_catalog(self):
+        # Called by 'search': the revision of the catalog is kept while it
+        # can be read, when the writer overwrites it the catalog is reopened
+        # (then it must still index the commit of the snapshot)
+        catalog = self.catalog
+        try:
+            catalog.get_metadata('last_commit')
+        except DatabaseModifiedError:
+            catalog.reopen()
+            self._wait_catalog(catalog)
+
+
+    def _get_handler(self, key, cls=None, soft=False):
+        # Cache hit
+        handler = self.cache.get(key)
+        if handler is not None:
+            # Check the class matches
+            if cls is not None and not isinstance(handler, cls):
+                error = "expected '%s' class, '%s' found"
+                raise LookupError, error % (cls, handler.__class__)
+            return handler
+
+        # Check the resource exists
+        fs = self.fs
+        sha = fs.files.get(key)
+        if sha is None:
+            # Folders are not cached
+            if fs.is_folder(key):
+                return Folder(key, database=self)
+            if soft:
+                return None
+            raise LookupError, 'the resource "%s" does not exist' % key
+
+        # The shared state
+        shared_key = (key, sha, cls)
+        handlers = self.handlers
+        with self.lock:
+            state = handlers.get(shared_key)
+            if state is not None:
+                handlers.touch(shared_key)
+
+        if state is None:
+            # Load the handler
+            if cls is None:
+                cls = self.get_handler_class(key)
+            handler = object.__new__(cls)
+            handler.database = self
+            handler.key = key
+            handler.load_state()
+            # Share its state
+            state = handler.__dict__.copy()
+            del state['database']
+            with self.lock:
+                handlers[shared_key] = (cls, state)
+        else:
+            cls, state = state
+            handler = object.__new__(cls)
+            handler.__dict__.update(state)
+            handler.database = self
+
+        self.cache[key] = handler
+        return handler
+
+
+    def has_handler(self, key):
+        key = self.normalize_key(key)
+        return self.fs.exists(key)
+
+
+    def get_blob(self, sha, cls):
+        # Not through the object cache of the worktree (not thread-safe)
+        git_cache = self.git_cache
+        if sha in git_cache:
+            return git_cache[sha]
+
+        blob = cls(string=self.worktree.repo[sha].data)
+        git_cache[sha] = blob
+        return blob
+
+
+    def get_blob_by_revision_and_path(self, sha, path, cls):
+        tree = self.worktree.repo[sha].tree
+        return self.get_blob(tree[path].hex, cls)
+
+
+    def get_resources(self, abspaths, soft=False, threads=None):
+        return [ self.get_resource(x, soft=soft) for x in abspaths ]
+
+
+    def validate_cache(self):
+        pass
+
+
+    def sync_metadata_cache(self, force=False):
+        pass
+
+
+    def reopen_catalog(self):
+        pass
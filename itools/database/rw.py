@@ -19,31 +19,62 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from cPickle import dump, load
 from datetime import datetime
 import fnmatch
 from heapq import heappush, heappop
-from os.path import dirname
+from multiprocessing import Process, Queue, cpu_count
+from os import fsync, stat
+from os.path import dirname, exists
+from Queue import Empty
+from time import time
+from traceback import format_exc
 
 # Import from pygit2
 import pygit2
-from pygit2 import TreeBuilder, GIT_FILEMODE_TREE
+from pygit2 import IndexEntry, TreeBuilder
+from pygit2 import GIT_FILEMODE_BLOB, GIT_FILEMODE_BLOB_EXECUTABLE
+from pygit2 import GIT_FILEMODE_TREE
 from pygit2 import GIT_CHECKOUT_FORCE, GIT_CHECKOUT_REMOVE_UNTRACKED
+from pygit2 import GIT_STATUS_CURRENT
 
 # Import from itools
-from itools.core import get_pipe, lazy
+from itools.core import lazy
 from itools.fs import lfs
-from itools.handlers import Folder
-from itools.log import log_error
+from itools.handlers import File, Folder
+from itools.log import log_error, log_info
 from catalog import Catalog, make_catalog
 from git import open_worktree
 from registry import get_register_fields
 from ro import RODatabase
+from writer import CatalogWriter, apply_catalog_ops
 
 
 
 MSG_URI_IS_BUSY = 'The "%s" URI is busy.'
 
 
+def get_file_mode(path):
+    """Returns the git mode of the given file (the absolute path).
+    """
+    if stat(path).st_mode & 0100:
+        return GIT_FILEMODE_BLOB_EXECUTABLE
+    return GIT_FILEMODE_BLOB
+
+
+def is_serializable(handler):
+    """Returns whether the handler can be saved with 'to_str', this is
+    whether it does not override the way 'File' saves its state.
+    """
+    if not isinstance(handler, File):
+        return False
+    cls = handler.__class__
+    for name in ('save_state', 'save_state_to_file'):
+        if getattr(cls, name).im_func is not getattr(File, name).im_func:
+            return False
+    return True
+
+
 
 class Heap(object):
     """
@@ -94,15 +125,194 @@ class Heap(object):
 
 
 
+class KeySet(object):
+    """A set of keys (relative paths like 'a/b/c'), indexed by folder, so
+    it is cheap to know whether there is any key within a folder, and which
+    are the names directly within a folder:
+
+       >>> keys = KeySet()
+       >>> keys.add('a/b/c')
+       >>> keys.is_folder('a')
+       True
+       >>> keys.get_children('a')
+       ['b']
+
+    For every folder ('' for the root) it keeps the number of keys within
+    every name, so adding or removing a key costs as much as its depth.
+
+    This data structure is used by RWDatabase to keep the keys added,
+    changed and removed in a transaction.
+    """
+
+    def __init__(self, keys=()):
+        self._keys = set()
+        self._folders = {}
+        for key in keys:
+            self.add(key)
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    def __iter__(self):
+        return iter(self._keys)
+
+
+    def __contains__(self, key):
+        return key in self._keys
+
+
+    def add(self, key):
+        if key in self._keys:
+            return
+        self._keys.add(key)
+
+        folders = self._folders
+        folder = ''
+        for name in key.split('/'):
+            children = folders.setdefault(folder, {})
+            children[name] = children.get(name, 0) + 1
+            folder = '%s/%s' % (folder, name) if folder else name
+
+
+    def discard(self, key):
+        if key not in self._keys:
+            return
+        self._keys.remove(key)
+
+        folders = self._folders
+        folder = ''
+        for name in key.split('/'):
+            children = folders[folder]
+            n = children[name] - 1
+            if n:
+                children[name] = n
+            else:
+                del children[name]
+                if not children:
+                    del folders[folder]
+            folder = '%s/%s' % (folder, name) if folder else name
+
+
+    def remove(self, key):
+        if key not in self._keys:
+            raise KeyError, key
+        self.discard(key)
+
+
+    def clear(self):
+        self._keys.clear()
+        self._folders.clear()
+
+
+    def copy(self):
+        return set(self._keys)
+
+
+    def is_folder(self, key):
+        """Returns whether there is any key within the given folder.
+        """
+        return key in self._folders
+
+
+    def get_children(self, key):
+        """Returns the names directly within the given folder.
+        """
+        return self._folders.get(key, {}).keys()
+
+
+    def get_keys(self, key):
+        """Returns the keys within the given folder.
+        """
+        keys = []
+        stack = [key]
+        while stack:
+            folder = stack.pop()
+            for name in self.get_children(folder):
+                path = '%s/%s' % (folder, name) if folder else name
+                if path in self._keys:
+                    keys.append(path)
+                if path in self._folders:
+                    stack.append(path)
+        return keys
+
+
+
+def _reindex_worker(ro_class, path, tasks, results, chunk_size):
+    """Function run by the worker processes of 'reindex_catalog_parallel'.
+    It reads shards from the 'tasks' queue, and sends the catalog values of
+    their resources, by chunks, to the 'results' queue.
+    """
+    try:
+        database = ro_class(path)
+    except Exception:
+        results.put(('error', None, format_exc()))
+        results.put(('exit', None, None))
+        return
+
+    while True:
+        shard = tasks.get()
+        if shard is None:
+            break
+
+        abspath, recursive = shard
+        try:
+            resource = database.get_resource(abspath, soft=True)
+            if resource is None:
+                resources = []
+            elif recursive:
+                resources = resource.traverse_resources()
+            else:
+                resources = [resource]
+
+            chunk = []
+            for resource in resources:
+                chunk.append(resource.get_catalog_values())
+                if len(chunk) == chunk_size:
+                    results.put(('values', shard, chunk))
+                    chunk = []
+            results.put(('done', shard, chunk))
+        except Exception:
+            results.put(('error', shard, format_exc()))
+
+        # Free memory
+        database._cleanup()
+
+    results.put(('exit', None, None))
+
+
+
+def get_group_message(transactions):
+    """Returns the message of the git commit of the given transactions,
+    a list of tuples (author, date, message).  See
+    'RWDatabase.start_group_commit'.
+    """
+    if len(transactions) == 1:
+        return transactions[0][2]
+
+    lines = ['%d transactions' % len(transactions), '']
+    for author, date, message in transactions:
+        message = message.splitlines() or ['']
+        lines.append('* %s' % message[0])
+        lines.extend([ '  %s' % x for x in message[1:] ])
+        if author:
+            lines.append('  Author: %s <%s>' % author)
+        if date:
+            lines.append('  Date: %s' % date.isoformat())
+    return '\n'.join(lines)
+
+
+
 class RWDatabase(RODatabase):
 
     def __init__(self, path, size_min, size_max):
         super(RWDatabase, self).__init__(path, size_min, size_max)
 
         # The "git add" arguments
-        self.added = set()
-        self.changed = set()
-        self.removed = set()
+        self.added = KeySet()
+        self.changed = KeySet()
+        self.removed = KeySet()
         self.has_changed = False
 
         # The resources that been added, removed, changed and moved can be
@@ -144,6 +354,26 @@ class RWDatabase(RODatabase):
         self.resources_old2new = {}
         self.resources_new2old = {}
 
+        # The catalog writer (see 'start_catalog_writer')
+        self.catalog_writer = None
+        self.catalog_ticket = None
+
+        # The group commit mode (see 'start_group_commit')
+        self.group_size = None
+        self.group_delay = None
+        self.group_durability = None
+        self.group_journal = None
+        # The transactions pending: their author, date and message, the
+        # catalog operations, the tree of the last one, and the time the
+        # first one was saved
+        self.group = []
+        self.group_ops = []
+        self.group_tree = None
+        self.group_time = None
+        # The last commit of the group, while its catalog operations are
+        # not saved (see 'flush_group_commit')
+        self.group_commit = None
+
 
     @lazy
     def catalog(self):
@@ -151,6 +381,267 @@ class RWDatabase(RODatabase):
         return Catalog(path, get_register_fields())
 
 
+    def start_catalog_writer(self, max_size=1000, max_delay=1.0, fsync=True):
+        """Switch the catalog to the write-behind mode: the changes to the
+        catalog are not applied by 'save_changes', they are queued and
+        committed by a background thread (see 'CatalogWriter').  The
+        searches are done on a read-only catalog, reopened at the end of
+        every request, so they may not see the last changes until the
+        writer commits them; use 'catalog_barrier' to wait for them.
+
+        The queued changes are kept in a journal file, they are replayed
+        if the process crashes before the catalog is committed.
+        """
+        if self.catalog_writer is not None:
+            return
+        self.flush_group_commit()
+
+        # The writer owns the writable catalog
+        path = '%s/catalog' % self.path
+        writer = CatalogWriter(self.catalog, '%s.journal' % path, max_size,
+                               max_delay, fsync)
+        writer.start()
+        self.catalog_writer = writer
+
+        # The searches are done on a read-only catalog
+        writer.wait()
+        self.catalog = Catalog(path, get_register_fields(), read_only=True)
+
+
+    def stop_catalog_writer(self):
+        """Commit the changes queued and go back to the synchronous mode.
+        """
+        writer = self.catalog_writer
+        if writer is None:
+            return
+        self.flush_group_commit()
+
+        writer.stop()
+        self.catalog_writer = None
+        self.catalog_ticket = None
+        self.catalog = writer.catalog
+
+
+    def catalog_barrier(self, ticket=None, timeout=None):
+        """Wait until the catalog changes of the given ticket (by default
+        the ticket of the last transaction) are committed, then reopen the
+        catalog so they are visible (read-your-writes).  Returns False if
+        the timeout expires first.
+        """
+        writer = self.catalog_writer
+        if writer is None:
+            return True
+
+        if ticket is None:
+            ticket = self.catalog_ticket
+        if not writer.wait(ticket, timeout):
+            return False
+        self.catalog.reopen()
+        return True
+
+
+    def reopen_catalog(self):
+        # Only the read-only catalog of the write-behind mode needs it
+        if self.catalog_writer is not None:
+            super(RWDatabase, self).reopen_catalog()
+
+
+    def _check_catalog_writer(self):
+        if self.catalog_writer is not None:
+            error = 'not available while the catalog writer runs'
+            raise RuntimeError, error
+
+
+    def _check_catalog_writer_state(self):
+        """Raise an error if the catalog writer cannot take more changes,
+        to be called before committing to git.
+        """
+        writer = self.catalog_writer
+        if writer is None:
+            return
+        if writer.error is not None:
+            raise RuntimeError, 'the catalog writer failed'
+        if writer.stopped:
+            raise RuntimeError, 'the catalog writer is stopped'
+
+
+    def start_group_commit(self, max_size=100, max_delay=1.0,
+                           durability='transaction'):
+        """Switch to the group commit mode: the transactions saved by
+        'save_changes' are not committed one by one, they are accumulated
+        and committed together, with a single git commit whose message
+        lists them, when there are 'max_size' transactions pending or after
+        'max_delay' seconds (checked at the end of every request).  The
+        catalog is saved once per group too.
+
+        The working tree, the handlers and the catalog searches see the
+        changes of every transaction at once.  The durability may be:
+
+          'transaction' -- every transaction writes the index file and is
+                           appended to a journal file (synced to the disk);
+                           if the process crashes, the transactions pending
+                           are committed when the group commit mode is
+                           started again
+          'group'       -- the transactions pending are only kept in
+                           memory, a crash loses them (the working tree may
+                           keep their files, see 'check_database')
+        """
+        if durability not in ('transaction', 'group'):
+            raise ValueError, 'unexpected durability "%s"' % durability
+        if self.group_size is not None:
+            return
+
+        # Commit the transactions left by a crash
+        path = '%sitools-group.journal' % self.worktree.repo.path
+        self._recover_group_commit(path)
+
+        self.group_size = max_size
+        self.group_delay = max_delay
+        self.group_durability = durability
+        if durability == 'transaction':
+            self.group_journal = open(path, 'ab')
+
+
+    def stop_group_commit(self):
+        """Commit the transactions pending and go back to the normal mode,
+        one git commit per transaction.
+        """
+        if self.group_size is None:
+            return
+
+        self.flush_group_commit()
+        self.group_size = None
+        self.group_delay = None
+        self.group_durability = None
+        if self.group_journal is not None:
+            self.group_journal.close()
+            self.group_journal = None
+
+
+    def flush_group_commit(self):
+        """Commit the transactions pending, returns the git commit, or None
+        if there is nothing to commit.
+        """
+        group = self.group
+        if not group and self.group_commit is None:
+            return None
+        self._check_catalog_writer_state()
+
+        # Git (the author is kept if it is the same for every transaction)
+        if group:
+            author = group[0][0]
+            for transaction in group:
+                if transaction[0] != author:
+                    author = None
+                    break
+            message = get_group_message(group)
+            commit = self.worktree.git_commit(message, author,
+                                              tree=self.group_tree)
+            self.worktree.refresh_index()
+            self.group = []
+            self.group_tree = None
+            self.group_time = None
+            self.group_commit = commit.hex
+
+        # Catalog (the operations have already been applied, unless in
+        # write-behind mode).  If this fails the operations are kept, they
+        # will be saved by the next call.
+        commit = self.group_commit
+        writer = self.catalog_writer
+        if writer is not None:
+            ops = self.group_ops + [('metadata', 'last_commit', commit)]
+            self.catalog_ticket = writer.put(ops)
+        else:
+            catalog = self.catalog
+            catalog.set_metadata('last_commit', commit)
+            catalog.save_changes()
+
+        # Done, the journal is not needed anymore
+        self.group_ops = []
+        self.group_commit = None
+        if self.group_journal is not None:
+            self.group_journal.truncate(0)
+
+        return self.worktree.repo[commit]
+
+
+    def _add_to_group(self, author, date, message, tree, ops):
+        worktree = self.worktree
+        if tree is None:
+            tree = worktree.index.write_tree()
+
+        # Durability
+        transaction = (author, date, message)
+        if self.group_durability == 'transaction':
+            worktree.write_index()
+            journal = self.group_journal
+            dump(transaction, journal, 2)
+            journal.flush()
+            fsync(journal.fileno())
+
+        if not self.group:
+            self.group_time = time()
+        self.group.append(transaction)
+        self.group_ops.extend(ops)
+        self.group_tree = tree
+
+
+    def _check_group_commit(self):
+        """Commit the transactions pending if there are enough of them, or
+        if the delay has expired.  If the commit fails they are kept, it will
+        be tried again.
+        """
+        group = self.group
+        if not group:
+            # The catalog operations left by a failure
+            if self.group_commit is None:
+                return
+        elif len(group) < self.group_size:
+            if time() - self.group_time < self.group_delay:
+                return
+
+        try:
+            self.flush_group_commit()
+        except Exception:
+            log_error('Group commit failed', domain='itools.database')
+
+
+    def _recover_group_commit(self, path):
+        if not exists(path):
+            return
+
+        # Read the journal
+        transactions = []
+        with open(path, 'rb') as journal:
+            while True:
+                try:
+                    transactions.append(load(journal))
+                except EOFError:
+                    break
+                except Exception:
+                    # The last record is incomplete (crash while writing)
+                    break
+        if not transactions:
+            return
+
+        # Commit the index file, it has the changes of the transactions
+        # (unless the crash happened after the commit)
+        worktree = self.worktree
+        tree = worktree.index.write_tree()
+        head = worktree._resolve_reference('HEAD')
+        if head is None or worktree.repo[head].tree.oid != tree:
+            message = get_group_message(transactions)
+            worktree.git_commit(message, tree=tree)
+            log_info('Recovered %d transactions' % len(transactions),
+                     domain='itools.database')
+
+        # The catalog may not have been saved either
+        if self.catalog_writer is None:
+            self.sync_catalog()
+
+        open(path, 'wb').close()
+
+
     #######################################################################
     # Layer 0: handlers
     #######################################################################
@@ -166,10 +657,9 @@ class RWDatabase(RODatabase):
         key = self.normalize_key(key)
 
         # A new file/directory is only in added
-        n = len(key)
-        for f_key in self.added:
-            if f_key[:n] == key and (len(f_key) == n or f_key[n] == '/'):
-                return True
+        added = self.added
+        if key in added or added.is_folder(key):
+            return True
 
         # Normal case
         return super(RWDatabase, self).has_handler(key)
@@ -177,11 +667,8 @@ class RWDatabase(RODatabase):
 
     def _get_handler(self, key, cls=None, soft=False):
         # A hook to handle the new directories
-        base = key + '/'
-        n = len(base)
-        for f_key in self.added:
-            if f_key[:n] == base:
-                return Folder(key, database=self)
+        if key and self.added.is_folder(key):
+            return Folder(key, database=self)
 
         # The other files
         return super(RWDatabase, self)._get_handler(key, cls, soft)
@@ -223,16 +710,13 @@ class RWDatabase(RODatabase):
             return
 
         # Case 2: folder
-        base = key + '/'
-        for k in self.added.copy():
-            if k.startswith(base):
-                self._discard_handler(k)
-                self.added.discard(k)
+        for k in self.added.get_keys(key):
+            self._discard_handler(k)
+            self.added.discard(k)
 
-        for k in self.changed.copy():
-            if k.startswith(base):
-                self._discard_handler(k)
-                self.changed.discard(k)
+        for k in self.changed.get_keys(key):
+            self._discard_handler(k)
+            self.changed.discard(k)
 
         if self.fs.exists(key):
             self.worktree.git_rm(key)
@@ -278,12 +762,7 @@ class RWDatabase(RODatabase):
         names = set(names)
 
         # In added
-        base = key + '/'
-        n = len(base)
-        for f_key in self.added:
-            if f_key[:n] == base:
-                name = f_key[n:].split('/', 1)[0]
-                names.add(name)
+        names.update(self.added.get_children(key))
 
         # Remove .git
         if key == "":
@@ -369,21 +848,18 @@ class RWDatabase(RODatabase):
 
         # Case 2: Folder
         n = len(source)
-        base = source + '/'
-        for key in self.added.copy():
-            if key.startswith(base):
-                new_key = '%s%s' % (target, key[n:])
-                handler = cache.pop(key)
-                self.push_handler(new_key, handler)
-                self.added.remove(key)
-                self.added.add(new_key)
-
-        for key in self.changed.copy():
-            if key.startswith(base):
-                new_key = '%s%s' % (target, key[n:])
-                handler = cache.pop(key)
-                self.push_handler(new_key, handler)
-                self.changed.remove(key)
+        for key in self.added.get_keys(source):
+            new_key = '%s%s' % (target, key[n:])
+            handler = cache.pop(key)
+            self.push_handler(new_key, handler)
+            self.added.remove(key)
+            self.added.add(new_key)
+
+        for key in self.changed.get_keys(source):
+            new_key = '%s%s' % (target, key[n:])
+            handler = cache.pop(key)
+            self.push_handler(new_key, handler)
+            self.changed.remove(key)
 
         if fs.exists(source):
             self.worktree.git_mv(source, target, add=False)
@@ -477,6 +953,7 @@ class RWDatabase(RODatabase):
     def _cleanup(self):
         super(RWDatabase, self)._cleanup()
         self.has_changed = False
+        self.reopen_catalog()
 
 
     def _abort_changes(self):
@@ -487,20 +964,33 @@ class RWDatabase(RODatabase):
         for key in self.changed:
             cache[key].abort_changes()
 
-        # 2. Git
+        # 2. Git (back to the last transaction saved in group commit mode)
         strategy = GIT_CHECKOUT_FORCE | GIT_CHECKOUT_REMOVE_UNTRACKED
-        if pygit2.__version__ >= '0.21.1':
-            self.worktree.repo.checkout_head(strategy=strategy)
+        repo = self.worktree.repo
+        if self.group_tree is not None:
+            tree = repo[self.group_tree]
+            if pygit2.__version__ >= '0.21.1':
+                repo.checkout_tree(tree, strategy=strategy)
+            else:
+                repo.checkout_tree(tree, strategy)
+            self.worktree.index.read_tree(tree)
+        elif pygit2.__version__ >= '0.21.1':
+            repo.checkout_head(strategy=strategy)
         else:
-            self.worktree.repo.checkout_head(strategy)
+            repo.checkout_head(strategy)
 
         # Reset state
         self.added.clear()
         self.changed.clear()
         self.removed.clear()
 
-        # 2. Catalog
-        self.catalog.abort_changes()
+        # 2. Catalog (nothing to abort in write-behind mode, the changes
+        # are queued by '_save_changes'); in group commit mode the changes
+        # of the transactions pending are applied again
+        if self.catalog_writer is None:
+            catalog = self.catalog
+            catalog.abort_changes()
+            apply_catalog_ops(catalog, self.group_ops)
 
         # 3. Resources
         self.resources_old2new.clear()
@@ -509,10 +999,15 @@ class RWDatabase(RODatabase):
 
     def abort_changes(self):
         if not self.has_changed:
+            self.validate_cache()
+            self.sync_metadata_cache()
+            self.reopen_catalog()
+            self._check_group_commit()
             return
 
         self._abort_changes()
         self._cleanup()
+        self._check_group_commit()
 
 
     def _before_commit(self):
@@ -529,44 +1024,74 @@ class RWDatabase(RODatabase):
     def _save_changes(self, data):
         worktree = self.worktree
 
-        # 1. Synchronize the handlers and the filesystem
+        # 1. Write the blobs: the handlers are serialized once, the same
+        # data is used for the blob and for the file in the working tree.
+        # The files written directly (e.g. by 'copy_handler'), and by the
+        # handlers that save themselves their own way, are read.
+        repo = worktree.repo
+        fs = self.fs
         added = self.added
-        for key in added:
+        changed = self.changed
+        blobs = {}
+        for key in list(added) + list(changed):
             handler = self.cache.get(key)
-            if handler and handler.dirty:
-                parent_path = dirname(key)
-                if not self.fs.exists(parent_path):
-                    self.fs.make_folder(parent_path)
+            if handler is None or not handler.dirty:
+                handler = None
+            elif not is_serializable(handler):
                 handler.save_state()
-
-        changed = self.changed
-        for key in changed:
-            handler = self.cache[key]
-            handler.save_state()
+                handler = None
+            if handler is None:
+                for path in worktree.walk(key):
+                    if path[-1] != '/':
+                        blobs[path] = repo.create_blob_fromworkdir(path)
+                continue
+
+            string = handler.to_str()
+            blobs[key] = repo.create_blob(string)
+            # The working tree
+            parent_path = dirname(key)
+            if parent_path and not fs.exists(parent_path):
+                fs.make_folder(parent_path)
+            file = fs.open(key, 'w')
+            try:
+                file.write(string)
+            finally:
+                file.close()
+            handler.timestamp = fs.get_mtime(key)
+            handler.dirty = None
 
         # 2. Build the 'git commit' command
         git_author, git_date, git_msg, docs_to_index, docs_to_unindex = data
         git_msg = git_msg or 'no comment'
 
-        # 3. Git add
-        git_add = list(added) + list(changed)
-        worktree.git_add(*git_add)
+        # 3. Update the index in bulk, from the blobs (the files are not read
+        # again, the stat data is refreshed after the commit)
+        index = worktree.index
+        modes = {}
+        for path, oid in blobs.iteritems():
+            mode = get_file_mode(worktree._get_abspath(path))
+            modes[path] = mode
+            index.add(IndexEntry(path, oid, mode))
+
+        # 4. Create the tree, on top of the tree of the last transaction in
+        # group commit mode
+        root = None
+        if self.group_tree is not None:
+            root = repo[self.group_tree]
+        else:
+            try:
+                root = repo.revparse_single('HEAD').tree
+            except KeyError:
+                pass
 
-        # 4. Create the tree
-        repo = worktree.repo
-        index = repo.index
-        try:
-            head = repo.revparse_single('HEAD')
-        except KeyError:
+        if root is None:
             git_tree = None
         else:
-            root = head.tree
             # Initialize the heap
             heap = Heap()
             heap[''] = repo.TreeBuilder(root)
-            for key in git_add:
-                entry = index[key]
-                heap[key] = (entry.oid, entry.mode)
+            for key, oid in blobs.iteritems():
+                heap[key] = (oid, modes[key])
             for key in self.removed:
                 heap[key] = None
 
@@ -613,30 +1138,53 @@ class RWDatabase(RODatabase):
                 else:
                     tb.insert(name, value[0], value[1])
 
-        # 5. Git commit
-        worktree.git_commit(git_msg, git_author, git_date, tree=git_tree)
+        # 5. Git commit (see '_add_to_group' for the group commit mode)
+        if self.group_size is None:
+            commit = worktree.git_commit(git_msg, git_author, git_date,
+                                         tree=git_tree)
+            worktree.refresh_index()
 
         # 6. Clear state
         changed.clear()
         added.clear()
         self.removed.clear()
 
-        # 7. Catalog
+        # 7. Catalog (the documents indexed replace the old ones, no need to
+        # unindex them first)
+        to_index = set([ values.get('abspath') for resource, values
+                         in docs_to_index ])
+        docs_to_unindex = [ x for x in docs_to_unindex if x not in to_index ]
+        ops = [ ('unindex', x) for x in docs_to_unindex ]
+        ops.extend([ ('index', values) for resource, values
+                     in docs_to_index ])
+        writer = self.catalog_writer
+
+        # Group commit: the catalog is saved by 'flush_group_commit'
+        if self.group_size is not None:
+            if writer is None:
+                apply_catalog_ops(self.catalog, ops)
+            self._add_to_group(git_author, git_date, git_msg, git_tree, ops)
+            return
+
+        ops.append(('metadata', 'last_commit', commit.hex))
+        if writer is not None:
+            self.catalog_ticket = writer.put(ops)
+            return
+
         catalog = self.catalog
-        for path in docs_to_unindex:
-            catalog.unindex_document(path)
-        for resource, values in docs_to_index:
-            catalog.index_document(values)
+        apply_catalog_ops(catalog, ops)
         catalog.save_changes()
 
 
     def save_changes(self):
         if not self.has_changed:
+            self._check_group_commit()
             return
 
         # Prepare for commit, do here the most you can, if something fails
         # the transaction will be aborted
         try:
+            self._check_catalog_writer_state()
             data = self._before_commit()
         except Exception:
             log_error('Transaction failed', domain='itools.database')
@@ -660,8 +1208,11 @@ class RWDatabase(RODatabase):
         finally:
             self._cleanup()
 
+        self._check_group_commit()
+
 
     def create_tag(self, tag_name, message=None):
+        self.flush_group_commit()
         worktree = self.worktree
         if message is None:
             message = tag_name
@@ -669,6 +1220,7 @@ class RWDatabase(RODatabase):
 
 
     def reset_to_tag(self, tag_name):
+        self.flush_group_commit()
         worktree = self.worktree
         try:
             # Reset the tree to the given tag name
@@ -687,24 +1239,25 @@ class RWDatabase(RODatabase):
     def reindex_catalog(self, base_abspath, recursif=True):
         """Reindex the catalog & return nb resources re-indexed
         """
+        self._check_catalog_writer()
         catalog = self.catalog
         base_resource = self.get_resource(base_abspath, soft=True)
         if base_resource is None:
             return 0
-        n = 0
         # Recursif ?
         if recursif:
-            for item in base_resource.traverse_resources():
-                catalog.unindex_document(str(item.abspath))
-                values = item.get_catalog_values()
-                catalog.index_document(values)
-                n += 1
+            resources = base_resource.traverse_resources()
         else:
-            # Reindex resource
-            catalog.unindex_document(base_abspath)
-            values = base_resource.get_catalog_values()
-            catalog.index_document(values)
-            n = 1
+            resources = [base_resource]
+        # Reindex (index_documents replaces the old documents)
+        documents = ( x.get_catalog_values() for x in resources )
+        batches = catalog.index_documents(documents)
+        n = sum([ x[0] for x in batches ])
+        # Full reindex, remember the last commit (see sync_catalog)
+        if base_abspath == '/' and recursif:
+            head = self.worktree._resolve_reference('HEAD')
+            if head is not None:
+                catalog.set_metadata('last_commit', head.hex)
         # Save catalog if has changes
         if n > 0:
             catalog.save_changes()
@@ -712,13 +1265,244 @@ class RWDatabase(RODatabase):
         return n
 
 
-def make_git_database(path, size_min, size_max, fields=None):
+    def _get_resource_abspath(self, path):
+        """Returns the abspath of the resource the given file (a path
+        relative to the working tree) belongs to: either its metadata file,
+        or a file attached to it.
+        """
+        # The metadata file
+        if path[-9:] == '.metadata':
+            return '/%s' % path[:-9]
+
+        # An attached file, like "a/b.pdf" or "a/b.fr.pdf" for "/a/b"
+        fs = self.fs
+        folder, name = path.rsplit('/', 1) if '/' in path else ('', path)
+        while '.' in name:
+            name = name.rsplit('.', 1)[0]
+            key = '%s/%s' % (folder, name) if folder else name
+            if fs.exists('%s.metadata' % key):
+                return '/%s' % key
+
+        # A file within the folder of a resource
+        return '/%s' % folder
+
+
+    def sync_catalog(self, since=None, until='HEAD'):
+        """Reindex the resources that have changed between the two given
+        commits, and return the number of resources reindexed or unindexed.
+
+        By default "since" is the last commit indexed, which is recorded in
+        the catalog by 'save_changes' and by a full 'reindex_catalog'.  If
+        it is unknown the whole catalog is reindexed.
+
+        The resources are read from the working tree, so "until" should be
+        the HEAD.  If "until" cannot be resolved LookupError is raised.
+        """
+        self._check_catalog_writer()
+        catalog = self.catalog
+        worktree = self.worktree
+
+        # Until
+        commit = worktree._resolve_reference(until)
+        if commit is None:
+            raise LookupError, 'unable to resolve "%s"' % until
+        until = commit if type(commit) is str else commit.hex
+
+        # Since
+        if since is None:
+            since = catalog.get_metadata('last_commit')
+            if since is None:
+                return self.reindex_catalog('/')
+
+        # The resources changed
+        abspaths = set()
+        for path in worktree.get_files_changed(since, until):
+            abspath = self._get_resource_abspath(path)
+            abspaths.add(abspath)
+
+        # Reindex the resources that exist, unindex the others
+        documents = []
+        for abspath in sorted(abspaths):
+            resource = self.get_resource(abspath, soft=True)
+            if resource is None:
+                catalog.unindex_document(abspath)
+            else:
+                documents.append(resource.get_catalog_values())
+        catalog.index_documents(documents)
+
+        # Save
+        catalog.set_metadata('last_commit', until)
+        catalog.save_changes()
+        return len(abspaths)
+
+
+    def _get_reindex_shards(self, abspath, depth):
+        """Split the tree of resources starting at the given abspath in
+        shards for 'reindex_catalog_parallel'.  A shard is a tuple with an
+        abspath and a boolean telling whether to reindex the whole subtree
+        (the resources at the given depth) or just the resource (the
+        resources above).
+        """
+        shards = []
+        todo = [(abspath, 0)]
+        while todo:
+            abspath, level = todo.pop()
+            if level == depth:
+                shards.append((abspath, True))
+                continue
+
+            shards.append((abspath, False))
+            key = abspath[1:]
+            if not self.fs.is_folder(key):
+                continue
+            base = abspath.rstrip('/')
+            for name in self.fs.get_names(key):
+                if name[-9:] == '.metadata' and name != '.metadata':
+                    todo.append(('%s/%s' % (base, name[:-9]), level + 1))
+
+        return shards
+
+
+    def reindex_catalog_parallel(self, base_abspath='/', processes=None,
+                                 depth=1, batch_size=1000, chunk_size=100,
+                                 ro_class=RODatabase, resume=True,
+                                 callback=None):
+        """Reindex the catalog using a pool of worker processes & return the
+        number of resources re-indexed.
+
+        The tree of resources is split in shards (the subtrees at the given
+        depth).  Every worker opens its own read-only database (an instance
+        of 'ro_class'), and sends the catalog values of the resources of
+        every shard, by chunks of 'chunk_size', to this process.  This
+        process is the only writer, it indexes the values and commits the
+        catalog every 'batch_size' documents.
+
+        The shards already committed are recorded in the catalog, so if the
+        process crashes the next call with 'resume' set to True will skip
+        them.
+
+        If given, the 'callback' will be called after every commit with
+        three arguments: the number of resources re-indexed, the number of
+        shards done, and the total number of shards.  Otherwise the progress
+        is logged.
+        """
+        self._check_catalog_writer()
+        catalog = self.catalog
+        if processes is None:
+            processes = cpu_count()
+
+        # The shards, skip the shards done by a previous call
+        shards = self._get_reindex_shards(base_abspath, depth)
+        state = catalog.get_metadata('reindex')
+        if resume and state and state['base'] == base_abspath:
+            done = [ tuple(x) for x in state['done'] ]
+        else:
+            done = []
+        todo = [ x for x in shards if x not in done ]
+        state = {'base': base_abspath, 'done': done}
+        total = len(shards)
+
+        # Start the workers
+        tasks = Queue()
+        for shard in todo:
+            tasks.put(shard)
+        for i in range(processes):
+            tasks.put(None)
+        results = Queue(maxsize=processes * 4)
+        workers = [
+            Process(target=_reindex_worker,
+                    args=(ro_class, self.path, tasks, results, chunk_size))
+            for i in range(processes) ]
+        for worker in workers:
+            worker.start()
+
+        # The writer
+        n = 0
+        pending = []
+        finished = []
+        errors = 0
+        running = processes
+        try:
+            while running:
+                try:
+                    kind, shard, data = results.get(timeout=1.0)
+                except Empty:
+                    # A worker died without telling (e.g. it was killed)
+                    for worker in workers:
+                        if worker.exitcode not in (None, 0):
+                            error = 'a reindex worker died (exit code %d)'
+                            raise RuntimeError, error % worker.exitcode
+                    continue
+
+                if kind == 'exit':
+                    running -= 1
+                    continue
+                if kind == 'error':
+                    where = shard[0] if shard else self.path
+                    log_error('Reindex of %s failed:\n%s' % (where, data),
+                              domain='itools.database')
+                    errors += 1
+                    continue
+
+                pending.extend(data)
+                if kind == 'done':
+                    finished.append(shard)
+                if len(pending) < batch_size:
+                    continue
+
+                # Commit (the shards done are saved with their documents)
+                catalog.index_documents(pending, batch_size)
+                n += len(pending)
+                pending = []
+                done.extend(finished)
+                finished = []
+                catalog.set_metadata('reindex', state)
+                catalog.save_changes()
+
+                # Progress
+                if callback is None:
+                    msg = 'Reindex: %d resources, %d/%d shards'
+                    log_info(msg % (n, len(done), total),
+                             domain='itools.database')
+                else:
+                    callback(n, len(done), total)
+        except:
+            # Stop, the shards committed are kept in the state (see
+            # 'resume'), the values pending are dropped
+            for worker in workers:
+                worker.terminate()
+            catalog.abort_changes()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+
+        # Flush the last values
+        if pending or finished:
+            catalog.index_documents(pending, batch_size)
+            n += len(pending)
+            done.extend(finished)
+
+        # Forget the state, unless there were errors
+        if errors == 0:
+            catalog.set_metadata('reindex', None)
+        else:
+            catalog.set_metadata('reindex', state)
+        catalog.save_changes()
+
+        return n
+
+
+
+def make_git_database(path, size_min, size_max, fields=None, shards=1):
     """Create a new empty Git database if the given path does not exists or
     is a folder.
 
     If the given path is a folder with content, the Git archive will be
     initialized and the content of the folder will be added to it in a first
     commit.
+
+    The catalog is split in the given number of shards, see 'make_catalog'.
     """
     path = lfs.get_absolute_path(path)
     # Git init
@@ -726,7 +1510,7 @@ def make_git_database(path, size_min, size_max, fields=None):
     # The catalog
     if fields is None:
         fields = get_register_fields()
-    catalog = make_catalog('%s/catalog' % path, fields)
+    catalog = make_catalog('%s/catalog' % path, fields, shards)
     # Ok
     database = RWDatabase(path, size_min, size_max)
     database.catalog = catalog
@@ -741,18 +1525,14 @@ def check_database(target):
 
     This is meant to be used by scripts, like 'icms-start.py'
     """
-    cwd = '%s/database' % target
-
-    # Check modifications to the working tree not yet in the index.
-    command = ['git', 'ls-files', '-m', '-d', '-o']
-    data1 = get_pipe(command, cwd=cwd)
+    worktree = open_worktree('%s/database' % target)
 
-    # Check changes in the index not yet committed.
-    command = ['git', 'diff-index', '--cached', '--name-only', 'HEAD']
-    data2 = get_pipe(command, cwd=cwd)
+    # Check modifications to the working tree not yet in the index (or not
+    # tracked), and changes in the index not yet committed.
+    status = worktree.repo.status()
 
     # Everything looks fine
-    if len(data1) == 0 and len(data2) == 0:
+    if not [ x for x in status.itervalues() if x != GIT_STATUS_CURRENT ]:
         return True
 
     # Something went wrong
@@ -0,0 +1,244 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The catalog writer implements the write-behind mode of the catalog: the
+index operations are queued, and a background thread applies them and
+commits the catalog.  See 'RWDatabase.start_catalog_writer'.
+"""
+
+# Import from the Standard Library
+from cPickle import dump, load
+from os import fsync
+from os.path import exists
+from threading import Condition, Thread
+from time import time
+
+# Import from itools
+from itools.log import log_error
+
+
+
+def apply_catalog_ops(catalog, ops):
+    """Apply the given operations (see 'CatalogWriter') to the catalog,
+    in order.  The catalog is not committed.
+    """
+    documents = []
+    for op in ops:
+        if op[0] == 'index':
+            documents.append(op[1])
+            continue
+        # Keep the order of the operations
+        if documents:
+            catalog.index_documents(documents)
+            documents = []
+        if op[0] == 'unindex':
+            catalog.unindex_document(op[1])
+        elif op[0] == 'metadata':
+            catalog.set_metadata(op[1], op[2])
+    if documents:
+        catalog.index_documents(documents)
+
+
+
+class CatalogWriter(Thread):
+    """The catalog writer owns the writable catalog, and is the only one to
+    use it.  The operations are given by 'put', they are a list of tuples:
+
+      ('index', values)       -- index the given catalog values
+      ('unindex', abspath)    -- unindex the given resource
+      ('metadata', key, value) -- see 'Catalog.set_metadata'
+
+    Before being queued the operations are appended to a journal file, so
+    if the process crashes they will be replayed the next time.  The
+    catalog is committed when there are 'max_size' operations pending, or
+    after 'max_delay' seconds, or when somebody is waiting (see 'wait').
+
+    If 'fsync' is False the journal is not synced to the disk, this is
+    faster but a system crash may lose the last operations.
+    """
+
+    def __init__(self, catalog, journal_path, max_size=1000, max_delay=1.0,
+                 fsync=True):
+        Thread.__init__(self, name='catalog-writer')
+        self.daemon = True
+        self.catalog = catalog
+        self.journal_path = journal_path
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.fsync = fsync
+
+        # State, protected by the condition
+        self.condition = Condition()
+        self.queue = []
+        self.waiting = 0
+        self.stopped = False
+        self.error = None
+
+        # The sequence numbers of the last operations queued and committed
+        self.committed = catalog.get_metadata('journal_seq') or 0
+        self.seq = self.committed
+
+        # Replay the operations not committed yet, then open the journal
+        self._load_journal()
+        self.journal = open(journal_path, 'ab')
+
+
+    def _load_journal(self):
+        if not exists(self.journal_path):
+            return
+
+        with open(self.journal_path, 'rb') as journal:
+            while True:
+                try:
+                    seq, ops = load(journal)
+                except EOFError:
+                    break
+                except Exception:
+                    # The last record is incomplete (crash while writing)
+                    break
+                if seq > self.committed:
+                    self.queue.append((seq, ops))
+                    self.seq = max(self.seq, seq)
+
+
+    def put(self, ops):
+        """Queue the given operations, returns the sequence number to wait
+        for (see 'wait').
+        """
+        with self.condition:
+            if self.error is not None:
+                raise RuntimeError, 'the catalog writer failed'
+            if self.stopped:
+                raise RuntimeError, 'the catalog writer is stopped'
+
+            self.seq += 1
+            # Journal
+            journal = self.journal
+            dump((self.seq, ops), journal, 2)
+            journal.flush()
+            if self.fsync:
+                fsync(journal.fileno())
+            # Queue
+            self.queue.append((self.seq, ops))
+            self.condition.notify_all()
+            return self.seq
+
+
+    def wait(self, seq=None, timeout=None):
+        """Block until the operations up to the given sequence number (by
+        default all the operations queued) are committed, or until the
+        timeout expires.  Returns True if they are committed.
+        """
+        condition = self.condition
+        with condition:
+            if seq is None:
+                seq = self.seq
+            if timeout is not None:
+                deadline = time() + timeout
+
+            self.waiting += 1
+            condition.notify_all()
+            try:
+                while self.committed < seq and self.error is None:
+                    if not self.is_alive():
+                        break
+                    if timeout is None:
+                        condition.wait(1.0)
+                    else:
+                        remaining = deadline - time()
+                        if remaining <= 0:
+                            break
+                        condition.wait(min(remaining, 1.0))
+            finally:
+                self.waiting -= 1
+
+            return self.committed >= seq
+
+
+    def stop(self):
+        """Commit the pending operations and stop the thread.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.join()
+        self.journal.close()
+
+
+    def _get_batch(self):
+        condition = self.condition
+        with condition:
+            # Wait for work
+            while not self.queue and not self.stopped:
+                condition.wait()
+            if not self.queue:
+                return None
+
+            # Wait for more work, unless somebody is waiting
+            deadline = time() + self.max_delay
+            while not self.stopped and not self.waiting:
+                if sum([ len(x[1]) for x in self.queue ]) >= self.max_size:
+                    break
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                condition.wait(remaining)
+
+            batch = self.queue
+            self.queue = []
+            return batch
+
+
+    def _apply(self, batch):
+        catalog = self.catalog
+        ops = []
+        for seq, x in batch:
+            ops.extend(x)
+        apply_catalog_ops(catalog, ops)
+
+        # Commit
+        catalog.set_metadata('journal_seq', batch[-1][0])
+        catalog.save_changes()
+
+
+    def run(self):
+        condition = self.condition
+        while True:
+            batch = self._get_batch()
+            if batch is None:
+                return
+
+            try:
+                self._apply(batch)
+            except Exception, e:
+                log_error('Catalog writer failed', domain='itools.database')
+                try:
+                    self.catalog.abort_changes()
+                except Exception:
+                    log_error('Aborting failed', domain='itools.database')
+                # The operations stay in the journal, they will be replayed
+                with condition:
+                    self.error = e
+                    condition.notify_all()
+                return
+
+            with condition:
+                self.committed = batch[-1][0]
+                # Everything is committed, empty the journal
+                if not self.queue:
+                    self.journal.truncate(0)
+                condition.notify_all()
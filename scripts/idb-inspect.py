@@ -27,18 +27,30 @@ from xapian import Database, DatabaseOpeningError, Enquire, Query
 
 # Import from itools
 from itools import __version__
+from itools.database.catalog import get_shard_paths
 
 
 def get_db(path):
-    # Get the DB
+    # Get the DB (combine the shards, if any)
+    paths = get_shard_paths(path)
     try:
-        return Database(path)
+        if paths is None:
+            return Database(path)
+        db = Database()
+        for path in paths:
+            db.add_database(Database(path))
+        return db
     except DatabaseOpeningError:
         print 'Bad DB, sorry'
         exit(1)
 
 
-def get_metadata(db):
+def get_metadata(db, path):
+    # The metadata is stored in the first shard
+    paths = get_shard_paths(path)
+    if paths is not None:
+        db = Database(paths[0])
+
     metadata = db.get_metadata('metadata')
     if metadata == '':
         return {}
@@ -63,12 +75,15 @@ def get_regexp(regexp):
     return None
 
 
-def dump_summary(db, metadata):
+def dump_summary(db, metadata, path):
     print 'Summary'
     print '======='
     print
     print (' * You have %d document(s) stocked in your '
            'database. ') % db.get_doccount()
+    paths = get_shard_paths(path)
+    if paths is not None:
+        print ' * %d shard(s).' % len(paths)
 
     total = stored = indexed = 0
     for name, info in metadata.iteritems():
@@ -222,7 +237,7 @@ if  __name__ == '__main__':
 
     # Inspect the db
     db = get_db(db_path)
-    metadata = get_metadata(db)
+    metadata = get_metadata(db, db_path)
     docs = get_docs(db)
 
     # Compile the regexp
@@ -231,7 +246,7 @@ if  __name__ == '__main__':
 
     # No field, No doc => just a summary
     if not (opts.fields or opts.docs):
-        dump_summary(db, metadata)
+        dump_summary(db, metadata, db_path)
     if opts.fields:
         dump_fields(db, metadata, docs, only_field, opts.values, opts.terms)
     if opts.docs:
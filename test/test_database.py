@@ -18,20 +18,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from cPickle import dump
 from unittest import TestCase, main
-from os.path import basename
+from os import utime
+from os.path import basename, dirname
 from random import sample
 import re
+from time import time
 
 # Import from itools
 from itools.database import AndQuery, RangeQuery, PhraseQuery, NotQuery
 from itools.database import AllQuery, OrQuery, TextQuery
 from itools.database import make_catalog, Catalog, Resource, StartQuery
-from itools.database import make_git_database
+from itools.database import make_git_database, RODatabase, QueryProfiler
+from itools.database import GitRODatabase, ReadonlyError
+from itools.database import get_register_fields, register_field
 from itools.database.catalog import _index, _decode
+from itools.database.git import ObjectCache
+from itools.database.metadata import Metadata, MetadataCache, get_blob_sha
+from itools.database.metadata import get_schema_fingerprint
+from itools.database.writer import CatalogWriter
+from itools.csv import Property
 from itools.datatypes import String, Unicode, Boolean, Integer
 from itools.fs import lfs, FileName
-from itools.handlers import TextFile
+from itools.handlers import File, TextFile
 from itools.log.log import register_logger, Logger, FATAL
 
 # Import from xapian
@@ -46,10 +56,22 @@ class BrokenHandler(TextFile):
 
 
 
+class UpperHandler(TextFile):
+
+    def save_state_to_file(self, file):
+        file.write(self.to_str().upper())
+        file.truncate(file.tell())
+
+
+
 class RWDatabaseTestCase(TestCase):
 
     def setUp(self):
         self.tearDown()
+        # The key field of the catalogs made by 'make_git_database' (it is
+        # unregistered by 'tearDown', if it was not registered before)
+        self.abspath_registered = 'abspath' not in get_register_fields()
+        register_field('abspath', String(indexed=True, stored=True))
         # Silence the log system
         logger = Logger(min_level=FATAL)
         register_logger(logger, 'itools.database')
@@ -63,11 +85,18 @@ class RWDatabaseTestCase(TestCase):
     def tearDown(self):
         # Restore logging
         register_logger(None, 'itools.database')
+        # Restore the fields registry
+        if getattr(self, 'abspath_registered', False):
+            del get_register_fields()['abspath']
+            self.abspath_registered = False
         # Clean file-system
         paths = ['fables/catalog',
+                 'fables/catalog.journal',
                  'fables/database/.git',
                  'fables/database/31.txt',
                  'fables/database/agenda',
+                 'fables/database/notes',
+                 'fables/database/notes.metadata',
                  'fables/database/broken.txt']
         for path in paths:
             if lfs.exists(path):
@@ -98,6 +127,41 @@ class RWDatabaseTestCase(TestCase):
         self.assertEqual(lfs.exists('fables/database/31.txt'), True)
 
 
+    def test_commit_status(self):
+        database = self.database
+        repo = database.worktree.repo
+        fables = self.root
+        # Added (also in a new folder)
+        fable = fables.get_handler('30.txt').clone()
+        fables.set_handler('31.txt', fable)
+        fables.set_handler('agenda/1.txt', TextFile())
+        database.save_changes()
+        # The index matches the working tree and the HEAD
+        self.assertEqual(repo.status(), {})
+        # Changed and removed
+        fable = fables.get_handler('31.txt')
+        fable.set_data(fable.to_str() + 'The end.\n')
+        fables.del_handler('agenda/1.txt')
+        fables.set_handler('agenda/2.txt', TextFile())
+        database.save_changes()
+        self.assertEqual(repo.status(), {})
+
+
+    def test_commit_save_state(self):
+        database = self.database
+        handler = UpperHandler(string='Hello\n')
+        self.root.set_handler('31.txt', handler)
+        database.save_changes()
+        # The handler saved its own way, in the file and in the commit
+        with open('fables/database/31.txt') as file:
+            self.assertEqual(file.read(), 'HELLO\n')
+        worktree = database.worktree
+        commit = worktree.repo[worktree._resolve_reference('HEAD')]
+        blob = worktree.repo[commit.tree['31.txt'].oid]
+        self.assertEqual(blob.data, 'HELLO\n')
+        self.assertEqual(worktree.repo.status(), {})
+
+
     def test_broken_commit(self):
         # Changes (copy&paste)
         fables = self.root
@@ -114,6 +178,331 @@ class RWDatabaseTestCase(TestCase):
         self.assertEqual(lfs.exists('fables/database/broken.txt'), False)
 
 
+    def test_cache_budget(self):
+        database = self.database
+        for name in ['03.txt', '08.txt', '10.txt']:
+            database.get_handler(name).load_state()
+        self.assertEqual(len(database.cache), 3)
+        # Within the budget
+        database.set_cache_budget(2**20)
+        database.make_room()
+        self.assertEqual(len(database.cache), 3)
+        # Over the budget of the class
+        database.set_cache_budget(2**20, {File: 1})
+        database.make_room()
+        self.assertEqual(len(database.cache), 0)
+
+
+    def test_cache_validation(self):
+        database = self.database
+        database.set_cache_validation('transaction')
+        handler = database.get_handler('30.txt')
+        handler.load_state()
+        self.assert_(database.get_handler('30.txt') is handler)
+        # Modified in the filesystem, trusted within the transaction
+        mtime = time() + 10
+        utime('fables/database/30.txt', (mtime, mtime))
+        self.assert_(database.get_handler('30.txt') is handler)
+        # Checked again in the next transaction
+        database.abort_changes()
+        self.assert_(database.get_handler('30.txt') is not handler)
+
+
+    def test_git_ro_database(self):
+        ro_database = GitRODatabase('fables')
+        handler = ro_database.get_handler('30.txt')
+        with open('fables/database/30.txt') as file:
+            self.assertEqual(handler.to_str(), file.read())
+        self.assertEqual(ro_database.get_handler('31.txt', soft=True), None)
+        # Commit
+        fables = self.root
+        fable = fables.get_handler('30.txt').clone()
+        fables.set_handler('31.txt', fable)
+        self.database.save_changes()
+        # End of the request
+        ro_database.abort_changes()
+        self.assert_('31.txt' in ro_database.get_handler_names('.'))
+        handler = ro_database.get_handler('31.txt')
+        self.assertEqual(handler.to_str(), fable.to_str())
+
+
+    def test_object_cache(self):
+        worktree = self.database.worktree
+        worktree.cache = ObjectCache(1, 2)
+        head = worktree._resolve_reference('HEAD')
+        commit = worktree.lookup(head)
+        self.assert_(worktree.lookup(head) is commit)
+        worktree.lookup_from_commit_by_path(commit, '30.txt')
+        self.assert_(len(worktree.cache) <= 2)
+        self.assertEqual(worktree.cache.get_stats()['hits'], 1)
+        # The log compares the SHAs
+        self.assertEqual(len(worktree.git_log(paths=['30.txt'])), 1)
+
+
+    def test_log_index(self):
+        worktree = self.database.worktree
+        self.assertEqual(len(worktree.git_log(paths=['30.txt'])), 1)
+        # Updated by the commits
+        fables = self.root
+        fables.set_handler('31.txt', fables.get_handler('30.txt').clone())
+        self.database.save_changes()
+        head = worktree._resolve_reference('HEAD')
+        self.assertEqual(worktree.log_index.head, head.hex)
+        self.assertEqual(len(worktree.git_log(paths=['31.txt'])), 1)
+        self.assertEqual(len(worktree.git_log(paths=['30.txt', '31.txt'])),
+                         2)
+
+
+    def test_diff(self):
+        worktree = self.database.worktree
+        since = worktree._resolve_reference('HEAD').hex
+        fables = self.root
+        fables.set_handler('31.txt', fables.get_handler('30.txt').clone())
+        self.database.save_changes()
+        # Files
+        files = worktree.get_files_changed(since, 'HEAD')
+        self.assertEqual(files, frozenset(['31.txt']))
+        # Diff
+        diff = worktree.git_diff(since, 'HEAD')
+        self.assert_(diff.startswith('diff --git a/31.txt b/31.txt'))
+        self.assertEqual(worktree.git_diff('HEAD'), diff)
+        self.assertEqual(worktree.git_diff(since, 'HEAD', ['30.txt']), '')
+        # Stats
+        stats = worktree.git_stats(since, 'HEAD')
+        self.assert_(stats.startswith(' 31.txt |'))
+        self.assert_(' 1 file changed, ' in stats)
+
+
+    def test_pending_folders(self):
+        database = self.database
+        database.set_handler('agenda/2012/01.txt', TextFile())
+        database.set_handler('agenda/2012/02.txt', TextFile())
+        self.assertEqual(database.has_handler('agenda'), True)
+        self.assertEqual(database.has_handler('agenda/2012'), True)
+        self.assertEqual(database.has_handler('agenda/2013'), False)
+        self.assert_('agenda' in database.get_handler_names(''))
+        names = database.added.get_children('agenda/2012')
+        self.assertEqual(sorted(names), ['01.txt', '02.txt'])
+        # Remove
+        database.del_handler('agenda/2012')
+        self.assertEqual(database.has_handler('agenda'), False)
+        self.assertEqual(len(database.added), 0)
+
+
+    def test_catalog_writer_error(self):
+        database = self.database
+        worktree = database.worktree
+        head = worktree._resolve_reference('HEAD').hex
+        database.start_catalog_writer()
+        database.catalog_writer.error = RuntimeError('failed')
+        # The transaction is refused before the git commit
+        self.root.set_handler('31.txt', TextFile())
+        self.assertRaises(RuntimeError, database.save_changes)
+        self.assertEqual(worktree._resolve_reference('HEAD').hex, head)
+        self.assertEqual(lfs.exists('fables/database/31.txt'), False)
+        database.stop_catalog_writer()
+
+
+    def test_group_commit(self):
+        database = self.database
+        worktree = database.worktree
+        head = worktree._resolve_reference('HEAD').hex
+        database.start_group_commit(max_size=3, max_delay=60)
+        fables = self.root
+        # Two transactions, not committed yet
+        for name in ['agenda/1.txt', 'agenda/2.txt']:
+            fables.set_handler(name, TextFile())
+            database.save_changes()
+        self.assertEqual(worktree._resolve_reference('HEAD').hex, head)
+        self.assertEqual(lfs.exists('fables/database/agenda/1.txt'), True)
+        # Abort, the transactions pending are kept
+        fables.set_handler('31.txt', TextFile())
+        database.abort_changes()
+        self.assertEqual(lfs.exists('fables/database/31.txt'), False)
+        self.assertEqual(lfs.exists('fables/database/agenda/2.txt'), True)
+        # The third transaction fills the group
+        fables.set_handler('agenda/3.txt', TextFile())
+        database.save_changes()
+        commit = worktree.repo[worktree._resolve_reference('HEAD')]
+        self.assertEqual(commit.parents[0].hex, head)
+        self.assert_(commit.message.startswith('3 transactions\n'))
+        files = worktree.get_files_changed(head, commit.hex)
+        self.assertEqual(len(files), 3)
+        database.stop_group_commit()
+
+
+    def test_snapshot_catalog(self):
+        database = self.database
+        first = database.worktree._resolve_reference('HEAD').hex
+        # A commit with a document indexed
+        database.catalog.index_document({'abspath': '/31'})
+        self.root.set_handler('31.txt', TextFile())
+        database.save_changes()
+        snapshot = database.get_snapshot()
+        self.assertEqual(len(snapshot.search(abspath='/31')), 1)
+        # The later commits are not seen by the snapshot
+        database.catalog.index_document({'abspath': '/32'})
+        self.root.set_handler('agenda/1.txt', TextFile())
+        database.save_changes()
+        self.assertEqual(len(snapshot.search(abspath='/32')), 0)
+        later = database.get_snapshot()
+        self.assertEqual(len(later.search(abspath='/32')), 1)
+        # Every snapshot has its own catalog
+        self.assert_(database.get_snapshot().catalog is not later.catalog)
+        # The catalog does not index the first commit
+        snapshot = database.get_snapshot(first)
+        self.assertRaises(LookupError, snapshot.search, abspath='/31')
+        # The catalog lags behind (a commit not indexed yet)
+        worktree = database.worktree
+        with open('fables/database/agenda/2.txt', 'w') as file:
+            file.write('Hello\n')
+        worktree.git_add('agenda/2.txt')
+        worktree.git_commit('Not indexed')
+        snapshot = database.get_snapshot()
+        snapshot.catalog_wait = 0.1
+        self.assertRaises(LookupError, snapshot.search, abspath='/31')
+        # It catches up
+        database.sync_catalog()
+        snapshot = database.get_snapshot()
+        self.assertEqual(len(snapshot.search(abspath='/31')), 1)
+
+
+    def test_group_commit_recovery(self):
+        database = self.database
+        worktree = database.worktree
+        head = worktree._resolve_reference('HEAD').hex
+        database.start_group_commit(max_size=10, max_delay=60)
+        self.root.set_handler('31.txt', TextFile())
+        database.save_changes()
+        # Simulate a crash: forget the transactions pending, then recover
+        # them from the journal
+        database.group = []
+        database.group_ops = []
+        database.group_tree = None
+        database._recover_group_commit(database.group_journal.name)
+        commit = worktree.repo[worktree._resolve_reference('HEAD')]
+        self.assertEqual(commit.parents[0].hex, head)
+        files = worktree.get_files_changed(head, commit.hex)
+        self.assertEqual(files, frozenset(['31.txt']))
+        database.stop_group_commit()
+
+
+    def test_snapshot(self):
+        database = self.database
+        snapshot = database.get_snapshot()
+        fable = snapshot.get_handler('30.txt')
+        data = fable.to_str()
+        # Changes are not seen by the snapshot
+        fables = self.root
+        fables.set_handler('31.txt', fables.get_handler('30.txt').clone())
+        database.save_changes()
+        self.assertEqual(snapshot.has_handler('31.txt'), False)
+        self.assertEqual(snapshot.get_handler('31.txt', soft=True), None)
+        # A new snapshot shares the state, not the handler
+        snapshot = database.get_snapshot()
+        self.assertEqual(snapshot.has_handler('31.txt'), True)
+        handler = snapshot.get_handler('30.txt')
+        self.assert_(handler is not fable)
+        self.assert_(handler.database is snapshot)
+        self.assertEqual(handler.to_str(), data)
+        # Read-only
+        self.assertRaises(ReadonlyError, handler.set_data, 'x')
+
+
+    def _make_notes(self, paths):
+        """Writes the metadata files of the given notes, directly in the
+        working tree.
+        """
+        for path in paths:
+            folder = dirname(path)
+            if folder and not lfs.exists('fables/database/%s' % folder):
+                lfs.make_folder('fables/database/%s' % folder)
+            with open('fables/database/%s.metadata' % path, 'w') as file:
+                file.write('format:%s\n' % Note.class_id)
+
+
+    def test_reindex_parallel(self):
+        # The resources: /notes, /notes/a, /notes/a/x, /notes/b and /notes/c
+        self._make_notes(['notes', 'notes/a', 'notes/a/x', 'notes/b',
+                          'notes/c'])
+
+        database = self.database
+        n = database.reindex_catalog('/notes')
+        self.assertEqual(n, 5)
+        m = database.reindex_catalog_parallel('/notes', processes=2)
+        self.assertEqual(m, n)
+        self.assertEqual(len(database.search(abspath='/notes/a/x')), 1)
+        self.assertEqual(database.catalog.get_metadata('reindex'), None)
+
+
+    def test_get_resources(self):
+        self._make_notes(['notes', 'notes/a', 'notes/b', 'notes/c'])
+        abspaths = ['/notes/c', '/notes/x', '/notes/a', '/notes/c', '/notes']
+        # Missing resources (the error gives the abspath)
+        database = self.database
+        try:
+            database.get_resources(abspaths)
+        except LookupError, e:
+            self.assertEqual(str(e), 'the resource "/notes/x" does not exist')
+        else:
+            self.fail('LookupError not raised')
+        # The resources added in the transaction
+        metadata = Metadata(format=Note.class_id, version='1')
+        database.set_handler('notes/d.metadata', metadata)
+        resources = database.get_resources(['/notes/d', '/notes/a'])
+        self.assert_(resources[0].metadata is metadata)
+        database.abort_changes()
+        # The class of the handlers in the cache is checked
+        database.get_handler('notes/b.metadata', TextFile)
+        self.assertRaises(LookupError, database.get_resources, ['/notes/b'])
+        # Soft, in the same order, with or without threads (a new database
+        # each time, so the metadata files are read)
+        expected = ['/notes/c', None, '/notes/a', '/notes/c', '/notes']
+        for threads in [None, 2]:
+            database = GitRODatabase('fables')
+            resources = database.get_resources(abspaths, soft=True,
+                                               threads=threads)
+            resources = [ str(x.abspath) if x is not None else None
+                          for x in resources ]
+            self.assertEqual(resources, expected)
+            # Again, from the cache
+            resources = database.get_resources(abspaths, soft=True,
+                                               threads=threads)
+            resources = [ str(x.abspath) if x is not None else None
+                          for x in resources ]
+            self.assertEqual(resources, expected)
+
+
+    def test_sync_catalog(self):
+        database = self.database
+        worktree = database.worktree
+        catalog = database.catalog
+        head = worktree._resolve_reference('HEAD').hex
+        catalog.set_metadata('last_commit', head)
+        catalog.save_changes()
+        # Changes made with the catalog out of the loop
+        self._make_notes(['notes', 'notes/a', 'notes/b'])
+        worktree.git_add('notes', 'notes.metadata')
+        worktree.git_commit('Add notes')
+        self.assertEqual(database.sync_catalog(), 3)
+        self.assertEqual(len(database.search(abspath='/notes/a')), 1)
+        # Only the resources changed are reindexed or unindexed
+        worktree.git_rm('notes/b.metadata')
+        self._make_notes(['notes/c'])
+        worktree.git_add('notes/c.metadata')
+        worktree.git_commit('Change notes')
+        self.assertEqual(database.sync_catalog(), 2)
+        self.assertEqual(len(database.search(abspath='/notes/a')), 1)
+        self.assertEqual(len(database.search(abspath='/notes/b')), 0)
+        self.assertEqual(len(database.search(abspath='/notes/c')), 1)
+        head = worktree._resolve_reference('HEAD').hex
+        self.assertEqual(catalog.get_metadata('last_commit'), head)
+        # Nothing to do
+        self.assertEqual(database.sync_catalog(), 0)
+        self.assertRaises(LookupError, database.sync_catalog,
+                          until='refs/heads/nothing')
+
+
     def test_remove_add(self):
         fables = self.root
         # Firstly add 31.txt
@@ -393,7 +782,8 @@ class CatalogTestCase(TestCase):
 
 
     def tearDown(self):
-        paths = ['fables/catalog', 'fables/database/.git']
+        paths = ['fables/catalog', 'fables/catalog.journal',
+                 'fables/database/.git']
         for path in paths:
             if lfs.exists(path):
                 lfs.remove(path)
@@ -444,6 +834,209 @@ class CatalogTestCase(TestCase):
         self.assertEqual(len(results), 2)
 
 
+    def test_count(self):
+        results = self.database.search(data=u'lion')
+        self.assertEqual(results.get_count(), 5)
+        self.assertEqual(results.get_count('exact'), len(results))
+        # Estimates
+        lower = results.get_count('lower')
+        upper = results.get_count('upper')
+        estimated = results.get_count('estimated', check_at_least=2)
+        self.assert_(lower <= 5 <= upper)
+        self.assert_(lower <= estimated <= upper)
+        # Bad mode
+        self.assertRaises(ValueError, results.get_count, 'about')
+
+
+    def test_iter_documents(self):
+        results = self.database.search(data=u'lion')
+        for sort_by, reverse, start, size in [('abspath', False, 0, 0),
+                                              ('abspath', True, 1, 3),
+                                              (None, True, 0, 0)]:
+            expected = [ x.abspath for x in results.get_documents(
+                sort_by, reverse, start, size) ]
+            documents = results.iter_documents(sort_by, reverse, start, size,
+                                               chunk_size=2)
+            self.assertEqual([ x.abspath for x in documents ], expected)
+
+
+    def test_index_documents(self):
+        database = self.database
+        catalog = database.catalog
+        n = len(database.search())
+        # Indexing again replaces the documents with the same abspath
+        documents = [ Document('fables/database/%s' % name)
+                      for name in ('03.txt', '08.txt', '10.txt') ]
+        batches = catalog.index_documents(documents, batch_size=2)
+        self.assertEqual([ x[0] for x in batches ], [2, 1])
+        catalog.index_document(documents[0])
+        catalog.save_changes()
+        self.assertEqual(len(database.search()), n)
+        self.assertEqual(len(database.search(data=u'lion')), 5)
+
+
+    def test_query_cache(self):
+        database = self.database
+        catalog = database.catalog
+        catalog.set_query_cache(10)
+        query_cache = catalog.query_cache
+
+        # The order of the atoms does not matter
+        query1 = AndQuery(PhraseQuery('data', u'mouse'),
+                          NotQuery(PhraseQuery('data', u'lion')))
+        query2 = AndQuery(NotQuery(PhraseQuery('data', u'lion')),
+                          PhraseQuery('data', u'mouse'))
+        abspaths = database.search(query1).get_abspaths(sort_by='abspath')
+        self.assertEqual(len(abspaths), 2)
+        self.assertEqual(query_cache.misses, 1)
+        self.assertEqual(
+            database.search(query2).get_abspaths(sort_by='abspath'),
+            abspaths)
+        self.assertEqual(query_cache.hits, 1)
+
+        # The cache is invalidated by changes
+        catalog.unindex_document(abspaths[0])
+        catalog.save_changes()
+        results = database.search(query1)
+        self.assertEqual(results.get_abspaths(sort_by='abspath'),
+                         abspaths[1:])
+        self.assertEqual(len(results), 1)
+        self.assertEqual(query_cache.get_stats()['misses'], 3)
+        catalog.set_query_cache(0)
+
+
+    def test_facets(self):
+        results = self.database.search(name='hello')
+        facets = results.get_facets(['lang', 'count'])
+        self.assertEqual(facets['lang'], {'de': 1, 'en': 1, 'es': 1, 'fr': 1})
+        self.assertEqual(sum(facets['count'].values()), 12)
+        # Limit
+        facets = results.get_facets(['lang'], limit=2)
+        self.assertEqual(len(facets['lang']), 2)
+
+
+    def test_fields_projection(self):
+        results = self.database.search(name='hello')
+        fields = ['abspath', 'lang', 'title_es', 'count', 'is_long']
+        documents = results.get_documents(sort_by='lang')
+        records = results.get_documents(sort_by='lang', fields=fields)
+        self.assertEqual(len(records), 4)
+        for document, record in zip(documents, records):
+            for name in fields:
+                self.assertEqual(getattr(record, name),
+                                 getattr(document, name))
+        # Not stored
+        self.assertRaises(AttributeError, results.get_documents,
+                          fields=['data'])
+
+
+    def test_reopen(self):
+        database = self.database
+        ro_database = RODatabase('fables')
+        ro_database.catalog = Catalog('fables/catalog', Document.fields,
+                                      read_only=True)
+        ro_database.catalog_check_interval = 0
+        self.assertEqual(len(ro_database.search(data=u'lion')), 5)
+        # The writer commits
+        database.catalog.unindex_document('03.txt')
+        database.catalog.save_changes()
+        self.assertEqual(len(ro_database.search(data=u'lion')), 5)
+        # End of the request
+        ro_database.abort_changes()
+        self.assertEqual(len(ro_database.search(data=u'lion')), 4)
+
+
+    def test_reopen_interval(self):
+        database = self.database
+        ro_database = RODatabase('fables')
+        ro_database.catalog = Catalog('fables/catalog', Document.fields,
+                                      read_only=True)
+        ro_database.catalog_check_interval = 60
+        ro_database.catalog_checked = time()
+        self.assertEqual(len(ro_database.search(data=u'lion')), 5)
+        # The writer commits, the next request comes within the interval
+        database.catalog.unindex_document('03.txt')
+        database.catalog.save_changes()
+        ro_database.abort_changes()
+        self.assertEqual(len(ro_database.search(data=u'lion')), 5)
+        # The check is still pending, it is done once the interval is over
+        ro_database.catalog_checked = 0
+        self.assertEqual(len(ro_database.search(data=u'lion')), 4)
+
+
+    def test_reopen_replace(self):
+        database = self.database
+        ro_database = RODatabase('fables')
+        ro_database.catalog = Catalog('fables/catalog', Document.fields,
+                                      read_only=True)
+        ro_database.catalog.set_query_cache(100)
+        ro_database.catalog_check_interval = 0
+        abspaths = ro_database.search(data=u'lion').get_abspaths()
+        self.assertEqual(len(abspaths), 5)
+        # The writer replaces a document (the counts do not change)
+        database.catalog.index_document({'abspath': abspaths[0],
+                                         'data': u'nothing'})
+        database.catalog.save_changes()
+        # The next request
+        ro_database.abort_changes()
+        self.assertEqual(len(ro_database.search(data=u'lion')), 4)
+
+
+    def test_profiler(self):
+        database = self.database
+        profiler = QueryProfiler(threshold=0)
+        database.catalog.profiler = profiler
+        # Silence the slow query log
+        register_logger(Logger(min_level=FATAL),
+                        'itools.database.slow_query')
+        try:
+            results = database.search(data=u'lion')
+            self.assertEqual(len(results), 5)
+            results.search(about_wolf=True).get_documents()
+        finally:
+            register_logger(None, 'itools.database.slow_query')
+            database.catalog.profiler = None
+
+        self.assertEqual(profiler.count, 2)
+        histograms = profiler.get_histograms()
+        self.assertEqual(sum([ x[1] for x in histograms['total'] ]), 2)
+        self.assertEqual(histograms['total'][-1][0], None)
+
+        # The number of matches, not the size of the page
+        records = []
+        profiler.record = lambda *args: records.append(args)
+        database.catalog.profiler = profiler
+        try:
+            results = database.search(data=u'lion')
+            results.get_documents(size=2)
+            list(results.iter_documents(chunk_size=2))
+            list(results.iter_documents(reverse=True, chunk_size=2))
+        finally:
+            database.catalog.profiler = None
+        matches = [ x[-1] for x in records if x[1] != 'count' ]
+        self.assertEqual(matches, [5] * 7)
+
+
+    def test_catalog_writer(self):
+        database = self.database
+        journal = 'fables/catalog.journal'
+        # Write-behind
+        writer = CatalogWriter(database.catalog, journal, max_delay=60)
+        writer.start()
+        seq = writer.put([('unindex', '03.txt')])
+        self.assertEqual(writer.wait(seq), True)
+        writer.stop()
+        self.assertEqual(len(database.search(data=u'lion')), 4)
+        # Replay the journal after a crash
+        with open(journal, 'ab') as f:
+            dump((seq + 1, [('unindex', '08.txt')]), f, 2)
+        writer = CatalogWriter(database.catalog, journal)
+        self.assertEqual(len(writer.queue), 1)
+        writer.start()
+        writer.stop()
+        self.assertEqual(len(database.search(data=u'lion')), 3)
+
+
     def test_AndQuery_empty(self):
         query = AndQuery()
         query.append(PhraseQuery('data', u'mouse'))
@@ -519,6 +1112,21 @@ class CatalogTestCase(TestCase):
         self.assert_('motorola' not in values)
 
 
+    def test_terms(self):
+        catalog = self.database.catalog
+        terms = catalog.get_terms('data', u'Lio')
+        self.assertEqual(terms[0], ('lion', 5))
+        terms = catalog.get_terms('data', u'l', limit=3)
+        self.assertEqual(len(terms), 3)
+        self.assertEqual(terms, sorted(terms))
+        # Next page
+        more = catalog.get_terms('data', u'l', start=terms[-1][0], limit=3)
+        self.assertEqual(more[0], terms[-1])
+        # Start past the last term
+        self.assertEqual(catalog.get_terms('data', start=u'zzzzzz'), [])
+        self.assertEqual(catalog.get_terms('data', u'l', start=u'lzzzz'), [])
+
+
     def test_start(self):
         data = [(u'The F', 5), (u'The Fox', 3)]
         for start, n in data:
@@ -579,6 +1187,120 @@ class BugXapianTestCase(TestCase):
 
 
 
+class ShardedCatalogTestCase(TestCase):
+
+    def setUp(self):
+        self.tearDown()
+        make_catalog('tests/catalog', Document_4.fields, shards=3)
+
+
+    def tearDown(self):
+        if lfs.exists('tests/catalog'):
+            lfs.remove('tests/catalog')
+
+
+    def test_everything(self):
+        cat = Catalog('tests/catalog', Document_4.fields)
+        self.assertEqual(len(cat._shards), 3)
+        for i in range(30):
+            cat.index_document(Document_4('doc%d' % i))
+        cat.index_document(Document_4('doc0'))
+        cat.unindex_document('doc1')
+        cat.save_changes()
+
+        # Read-only
+        cat = Catalog('tests/catalog', Document_4.fields, read_only=True)
+        self.assertEqual(cat._db.get_doccount(), 29)
+        counts = [ x.get_doccount() for x in cat._shards ]
+        self.assertEqual(sum(counts), 29)
+        self.assert_(0 not in counts)
+        self.assert_('doc0' in cat.get_unique_values('abspath'))
+
+
+
+class MetadataCacheTestCase(TestCase):
+
+    def tearDown(self):
+        if lfs.exists('tests/metadata.cache'):
+            lfs.remove('tests/metadata.cache')
+
+
+    def test_everything(self):
+        # Same as "git hash-object"
+        sha = get_blob_sha('')
+        self.assertEqual(sha, 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391')
+
+        cache = MetadataCache('tests/metadata.cache', interval=0)
+        sha = get_blob_sha('format:test\ntitle:Hello\n')
+        cache.set(sha, ('test', None, {'title': Property(u'Hello')}))
+        cache.sync()
+
+        # Reload
+        cache = MetadataCache('tests/metadata.cache')
+        self.assertEqual(len(cache), 1)
+        format, version, properties = cache.get(sha)
+        self.assertEqual(format, 'test')
+        self.assertEqual(properties['title'].value, u'Hello')
+
+
+    def test_fingerprint(self):
+        fingerprint = get_schema_fingerprint({'document': Document})
+        self.assertEqual(fingerprint,
+                         get_schema_fingerprint({'document': Document}))
+        self.assertNotEqual(fingerprint, get_schema_fingerprint({}))
+
+        # The cache is ignored if the schema changes
+        cache = MetadataCache('tests/metadata.cache', 0, fingerprint)
+        cache.set(get_blob_sha(''), ('test', None, {}))
+        cache.sync()
+        cache = MetadataCache('tests/metadata.cache', 0, fingerprint)
+        self.assertEqual(len(cache), 1)
+        cache = MetadataCache('tests/metadata.cache', 0, 'other')
+        self.assertEqual(len(cache), 0)
+
+
+    def test_size(self):
+        cache = MetadataCache('tests/metadata.cache', interval=0, size=10)
+        for i in range(100):
+            cache.set(get_blob_sha(str(i)), ('test', None, {}))
+            cache.sync()
+        self.assert_(len(cache) <= 11)
+
+        # Reload
+        cache = MetadataCache('tests/metadata.cache', size=10)
+        self.assert_(len(cache) <= 11)
+        self.assertNotEqual(cache.get(get_blob_sha('99')), None)
+        # No temporary file is left
+        names = [ x for x in lfs.get_names('tests')
+                  if x.startswith('metadata.cache.') ]
+        self.assertEqual(names, [])
+
+
+    def test_append(self):
+        # Two processes share the cache, the records are appended
+        cache = MetadataCache('tests/metadata.cache', interval=0)
+        cache.set(get_blob_sha('a'), ('test', None, {}))
+        cache.sync()
+        cache1 = MetadataCache('tests/metadata.cache', interval=0)
+        cache2 = MetadataCache('tests/metadata.cache', interval=0)
+        cache1.set(get_blob_sha('b'), ('test', None, {}))
+        cache2.set(get_blob_sha('c'), ('test', None, {}))
+        cache1.sync()
+        cache2.sync()
+        cache = MetadataCache('tests/metadata.cache')
+        self.assertEqual(len(cache), 3)
+
+
+    def test_corrupt(self):
+        cache = MetadataCache('tests/metadata.cache', interval=0)
+        sha = get_blob_sha('')
+        cache.set(sha, ('test', None, {}))
+        cache.data[sha] = 'not a pickle'
+        self.assertEqual(cache.get(sha), None)
+        self.assertEqual(len(cache), 0)
+
+
+
 class Document(Resource):
 
     fields = {
@@ -628,6 +1350,36 @@ class Document(Resource):
 
 
 
+class Note(Resource):
+    """A resource made of its metadata file, and the resources in its
+    folder.
+    """
+
+    class_id = 'test-note'
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+
+    def traverse_resources(self):
+        yield self
+        database = self.metadata.database
+        abspath = str(self.abspath)
+        key = abspath[1:]
+        if not database.fs.is_folder(key):
+            return
+        for name in sorted(database.get_handler_names(key)):
+            if name[-9:] == '.metadata':
+                child = database.get_resource('%s/%s' % (abspath, name[:-9]))
+                for resource in child.traverse_resources():
+                    yield resource
+
+
+    def get_catalog_values(self):
+        return {'abspath': str(self.abspath)}
+
+
+
 class Document_4(Resource):
 
     fields = {'abspath': String(stored=True, indexed=True)}